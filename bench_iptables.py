@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+'''
+Compare the number of iptables processes and the wall time of the
+iptables forward methods with and without iptables-restore batching.
+
+Needs root (or --sudo) and iptables. The rules are added to the NATTER and
+NATTER_SNAT chains and removed again; other rules are not touched.
+'''
+
+import time
+import argparse
+
+from natter import ForwardIptables
+
+
+def bench(use_restore, rounds, snat, sudo):
+    ts = time.time()
+    fwd = ForwardIptables(snat=snat, sudo=sudo, use_restore=use_restore)
+    for i in range(rounds):
+        port = 20000 + i
+        fwd.start_forward("127.0.0.1", port, "127.0.0.1", port + 10000)
+        fwd.stop_forward()
+    return fwd.forks, time.time() - ts, fwd.use_restore
+
+
+def main():
+    argp = argparse.ArgumentParser(description="Benchmark iptables batching")
+    argp.add_argument("-n", type=int, default=20, help="forward rounds (default 20)")
+    argp.add_argument("--snat", action="store_true", help="add SNAT rules too")
+    argp.add_argument("--sudo", action="store_true", help="run iptables via sudo -n")
+    args = argp.parse_args()
+
+    for name, use_restore in (("iptables", False), ("iptables-restore", True)):
+        forks, elapsed, used = bench(use_restore, args.n, args.snat, args.sudo)
+        if use_restore and not used:
+            name += " (unavailable, fell back)"
+        print("%-18s %4d processes  %8.1f ms  %6.1f ms/round" % (
+            name, forks, elapsed * 1000, elapsed * 1000 / args.n
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+'''
+Compare the TCP throughput of the socket and socket-splice forward methods,
+the latter with splice() and with its recv_into() fallback.
+
+Everything runs over loopback in one process: a client sends the data
+through the forwarder to a server that counts it.
+'''
+
+import time
+import socket
+import argparse
+import threading
+
+from natter import ForwardSocket, ForwardSocketSplice
+
+
+def sink_server(sock, result):
+    conn, _ = sock.accept()
+    buff = bytearray(65536)
+    received = 0
+    with conn:
+        while True:
+            n = conn.recv_into(buff)
+            if not n:
+                break
+            received += n
+    result.append(received)
+
+
+def bench(forwarder, port, total):
+    srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    srv.bind(("127.0.0.1", port + 1))
+    srv.listen(1)
+    result = []
+    sink = threading.Thread(target=sink_server, args=(srv, result), daemon=True)
+    sink.start()
+    forwarder.start_forward("127.0.0.1", port, "127.0.0.1", port + 1)
+    try:
+        sock = socket.create_connection(("127.0.0.1", port))
+        chunk = b"\x00" * 65536
+        ts = time.time()
+        sent = 0
+        while sent < total:
+            sent += sock.send(chunk[:total - sent])
+        sock.close()
+        sink.join()
+        elapsed = time.time() - ts
+    finally:
+        forwarder.stop_forward()
+        srv.close()
+    if result != [total]:
+        raise RuntimeError("received %s of %d bytes" % (result, total))
+    return elapsed
+
+
+def main():
+    argp = argparse.ArgumentParser(description="Benchmark splice() TCP forwarding")
+    argp.add_argument("-m", type=int, default=200, help="MiB sent per method (default 200)")
+    argp.add_argument("-p", type=int, default=21000, help="first local port (default 21000)")
+    args = argp.parse_args()
+
+    total = args.m * 1024 * 1024
+    splice = ForwardSocketSplice()
+    fallback = ForwardSocketSplice()
+    fallback.use_splice = False
+    methods = [("socket", ForwardSocket()), ("socket-splice (fallback)", fallback)]
+    if splice.use_splice:
+        methods.append(("socket-splice", splice))
+    else:
+        print("socket-splice: os.splice() is unavailable, only the fallback is measured")
+    for i, (name, forwarder) in enumerate(methods):
+        elapsed = bench(forwarder, args.p + i * 2, total)
+        print("%-26s %8.1f ms  %8.1f MB/s" % (
+            name, elapsed * 1000, total / elapsed / 1e6
+        ))
+
+
+if __name__ == "__main__":
+    main()
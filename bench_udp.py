@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+'''
+Compare the UDP packet rate of the socket forward method with and without
+batched I/O (UDP_GRO receive, UDP_SEGMENT send).
+
+Everything runs over loopback in one process: a client sends small
+datagrams through the forwarder to a sink that counts them. The client
+sends either one datagram per sendto() or runs of them with UDP_SEGMENT.
+'''
+
+import time
+import socket
+import argparse
+import threading
+
+from natter import ForwardSocket, UdpBatch
+
+
+def sink_server(sock, result):
+    sock.settimeout(1)
+    buff = bytearray(65536)
+    count = 0
+    last = None
+    try:
+        while True:
+            sock.recv_into(buff)
+            count += 1
+            last = time.time()
+    except socket.timeout:
+        pass
+    result.append((count, last))
+
+
+def bench(batching, gso_send, port, count, size):
+    UdpBatch.supported = batching
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    sink.bind(("127.0.0.1", port + 1))
+    forwarder = ForwardSocket()
+    forwarder.rcvbuf = forwarder.sndbuf = 4 * 1024 * 1024
+    forwarder.start_forward("127.0.0.1", port, "127.0.0.1", port + 1, udp=True)
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect(("127.0.0.1", port))
+        # open the session before measuring
+        sock.send(b"\x00" * size)
+        time.sleep(0.5)
+        result = []
+        thread = threading.Thread(target=sink_server, args=(sink, result), daemon=True)
+        thread.start()
+        sender = UdpBatch()
+        run = 64 if gso_send else 1
+        data = b"\x00" * (size * run)
+        ts = time.time()
+        sent = 0
+        while sent < count:
+            try:
+                sent += sender.send(sock, data, size if gso_send else 0)
+            except (BlockingIOError, ConnectionRefusedError):
+                pass
+        thread.join()
+        sock.close()
+    finally:
+        forwarder.stop_forward()
+        sink.close()
+    received, last = result[0]
+    elapsed = (last or time.time()) - ts
+    return sent, received, elapsed
+
+
+def main():
+    argp = argparse.ArgumentParser(description="Benchmark batched UDP forwarding")
+    argp.add_argument("-n", type=int, default=400000, help="datagrams per run (default 400000)")
+    argp.add_argument("-s", type=int, default=100, help="datagram size (default 100)")
+    argp.add_argument("-p", type=int, default=22000, help="first local port (default 22000)")
+    args = argp.parse_args()
+
+    supported = UdpBatch.supported
+    if not supported:
+        print("batched UDP I/O is unavailable, only plain I/O is measured")
+    runs = []
+    for gso_send in ((False, True) if supported else (False,)):
+        for batching in ((False, True) if supported else (False,)):
+            runs.append((batching, gso_send))
+    for i, (batching, gso_send) in enumerate(runs):
+        sent, received, elapsed = bench(batching, gso_send, args.p + i * 2, args.n, args.s)
+        print("%-22s %-9s %9.0f pps  %5.1f%% delivered" % (
+            "GSO sender" if gso_send else "one per sendto()",
+            "batched" if batching else "plain",
+            received / elapsed, received * 100 / sent
+        ))
+    UdpBatch.supported = supported
+
+
+if __name__ == "__main__":
+    main()
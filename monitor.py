@@ -5,12 +5,18 @@ import json
 import os
 from datetime import datetime
 import sys
+import time
 import argparse
+import threading
 
 class NatterMonitor:
     def __init__(self, natter_args=None):
         self.status_file = "data/status.json"
         self.log_file = "data/natter.log"
+        self.stats_file = "data/forward_stats.json"
+        self.stun_scoreboard = "data/stun_scoreboard.json"
+        self.stats_interval = 10
+        self.status_lock = threading.Lock()
         self.natter_args = natter_args or {}
         self.current_status = {
             "outer_ip": None,
@@ -21,11 +27,14 @@ class NatterMonitor:
             "status": "starting",
             "timestamp": None,
             "log": "",
+            "forward_stats": None,
             "natter_args": self.natter_args
         }
         
         os.makedirs("data", exist_ok=True)
         self.clear_log_file()
+        if os.path.exists(self.stats_file):
+            os.remove(self.stats_file)
     
     def clear_log_file(self):
         """清空日志文件"""
@@ -117,13 +126,32 @@ class NatterMonitor:
             except:
                 pass
             self.current_status["log"] = log_line[-500:]
+        
+        forward_stats = self.read_forward_stats()
+        if forward_stats:
+            self.current_status["forward_stats"] = forward_stats
             
         try:
-            with open(self.status_file, 'w', encoding='utf-8') as f:
-                json.dump(self.current_status, f, ensure_ascii=False, indent=2)
+            with self.status_lock:
+                with open(self.status_file, 'w', encoding='utf-8') as f:
+                    json.dump(self.current_status, f, ensure_ascii=False, indent=2)
         except Exception as e:
             print(f"写入状态文件失败: {e}")
     
+    def read_forward_stats(self):
+        """读取Natter写出的转发统计"""
+        try:
+            with open(self.stats_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception:
+            return None
+    
+    def refresh_stats_loop(self):
+        """定期刷新状态文件中的转发统计"""
+        while True:
+            time.sleep(self.stats_interval)
+            self.update_status_file()
+    
     def write_log(self, line):
         """写入完整日志文件"""
         try:
@@ -146,8 +174,13 @@ class NatterMonitor:
         for arg, value in self.natter_args.items():
             if value is True:
                 cmd.append(arg)
+            elif isinstance(value, list):
+                for item in value:
+                    cmd.extend([arg, str(item)])
             elif value is not None and value is not False:
                 cmd.extend([arg, str(value)])
+        cmd.extend(['--stats-file', self.stats_file])
+        cmd.extend(['--stun-scoreboard', self.stun_scoreboard])
         
         return cmd
     
@@ -157,6 +190,7 @@ class NatterMonitor:
         if self.natter_args:
             print(f"📋 参数: {self.natter_args}")
         self.update_status_file(status="running")
+        threading.Thread(target=self.refresh_stats_loop, daemon=True).start()
         
         try:
             cmd = self.build_natter_command()
@@ -219,14 +253,27 @@ def main():
     parser.add_argument('-u', '--udp', action='store_true', help='UDP模式')
     parser.add_argument('-U', '--upnp', action='store_true', help='启用UPnP')
     parser.add_argument('-k', '--keep-alive', type=int, help='保活间隔（秒）')
+    parser.add_argument('--adaptive-keep-alive', action='store_true', help='自动探测NAT映射超时并延长保活间隔（仅UDP）')
     parser.add_argument('-s', '--stun-server', help='STUN服务器地址')
+    parser.add_argument('--stun-parallel', type=int, help='同时查询的STUN服务器数量')
     parser.add_argument('--keep-alive-server', dest='keep_alive_server', help='保活服务器地址')
+    parser.add_argument('--keep-alive-parallel', type=int, help='同时发送保活的服务器数量')
     parser.add_argument('-e', '--hook-script', help='映射地址通知脚本路径')
     parser.add_argument('-i', '--interface', help='网络接口名称或IP')
     parser.add_argument('-b', '--bind-port', type=int, help='绑定端口号')
     parser.add_argument('-m', '--forward-method', help='转发方法')
     parser.add_argument('-t', '--forward-target', help='转发目标IP地址')
+    parser.add_argument('--map', action='append', help='在同一进程中再打开一个端口，格式 [tcp:|udp:][绑定端口:]IP:端口，可多次使用')
     parser.add_argument('-r', '--retry', action='store_true', help='持续重试')
+    parser.add_argument('--backlog', type=int, help='等待转发的连接队列长度')
+    parser.add_argument('--max-conns', dest='max_conns', type=int, help='最大并发转发连接数')
+    parser.add_argument('--max-sessions', dest='max_sessions', type=int, help='最大UDP会话数')
+    parser.add_argument('--prewarm', type=int, help='预先建立到转发目标的空闲连接数')
+    parser.add_argument('--processes', type=int, help='转发进程数（SO_REUSEPORT）')
+    parser.add_argument('--rcvbuf', type=int, help='转发套接字接收缓冲区大小（字节）')
+    parser.add_argument('--sndbuf', type=int, help='转发套接字发送缓冲区大小（字节）')
+    parser.add_argument('--rate-limit', type=int, help='所有客户端公平共享的转发带宽（KiB/s）')
+    parser.add_argument('--rate-limit-ip', type=int, help='每个客户端IP的转发带宽（KiB/s）')
     
     args = parser.parse_args()
     
@@ -239,14 +286,27 @@ def main():
     if args.udp: natter_args['-u'] = True
     if args.upnp: natter_args['-U'] = True
     if args.keep_alive: natter_args['-k'] = args.keep_alive
+    if args.adaptive_keep_alive: natter_args['--adaptive-keep-alive'] = True
     if args.stun_server: natter_args['-s'] = args.stun_server
+    if args.stun_parallel: natter_args['--stun-parallel'] = args.stun_parallel
     if args.keep_alive_server: natter_args['-h'] = args.keep_alive_server
+    if args.keep_alive_parallel: natter_args['--keep-alive-parallel'] = args.keep_alive_parallel
     if args.hook_script: natter_args['-e'] = args.hook_script
     if args.interface: natter_args['-i'] = args.interface
     if args.bind_port: natter_args['-b'] = args.bind_port
     if args.forward_method: natter_args['-m'] = args.forward_method
     if args.forward_target: natter_args['-t'] = args.forward_target
+    if args.map: natter_args['--map'] = args.map
     if args.retry: natter_args['-r'] = True
+    if args.backlog: natter_args['--backlog'] = args.backlog
+    if args.max_conns: natter_args['--max-conns'] = args.max_conns
+    if args.max_sessions: natter_args['--max-sessions'] = args.max_sessions
+    if args.prewarm: natter_args['--prewarm'] = args.prewarm
+    if args.processes: natter_args['--processes'] = args.processes
+    if args.rcvbuf: natter_args['--rcvbuf'] = args.rcvbuf
+    if args.sndbuf: natter_args['--sndbuf'] = args.sndbuf
+    if args.rate_limit: natter_args['--rate-limit'] = args.rate_limit
+    if args.rate_limit_ip: natter_args['--rate-limit-ip'] = args.rate_limit_ip
     
     monitor = NatterMonitor(natter_args=natter_args)
     
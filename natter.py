@@ -24,15 +24,22 @@ import sys
 import json
 import time
 import errno
+import queue
 import atexit
 import codecs
 import random
+import select
 import signal
 import socket
 import struct
+import asyncio
 import argparse
+import selectors
 import threading
 import subprocess
+import collections
+import multiprocessing
+import concurrent.futures
 
 __version__ = "2.2.0"
 
@@ -100,6 +107,71 @@ class NatterExit(object):
         NatterExit._atexit[0] = func
 
 
+class DnsCache(object):
+    # Shared resolver cache for STUN, keep-alive and port-test hosts.
+    # getaddrinfo() does not return TTLs, so a fixed one is used. Expired
+    # entries are still served while a background thread refreshes them, and
+    # lookup failures are cached too, so callers rarely block on DNS.
+    ttl = 300
+    negative_ttl = 30
+    stale_ttl = 3600        # serve an expired address for at most this long
+    cache = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def resolve(addr):
+        host, port = addr
+        try:
+            socket.inet_aton(host)
+            return addr
+        except (OSError, socket.error):
+            pass
+        now = time.time()
+        with DnsCache.lock:
+            entry = DnsCache.cache.get(host)
+        if entry is None or (entry["error"] is None and now - entry["ts"] > DnsCache.stale_ttl):
+            entry = DnsCache._lookup(host)
+        elif now > entry["expire"] or now > entry["ts"] + DnsCache.ttl * 0.8:
+            DnsCache._refresh(host, entry)
+        if entry["error"] is not None:
+            raise entry["error"]
+        return entry["ip"], port
+
+    @staticmethod
+    def _lookup(host):
+        now = time.time()
+        try:
+            info = socket.getaddrinfo(host, None, socket.AF_INET, socket.SOCK_STREAM)
+            entry = {"ip": info[0][4][0], "error": None, "ts": now, "expire": now + DnsCache.ttl}
+            Logger.debug("dns: Resolved %s to %s" % (host, entry["ip"]))
+        except (OSError, socket.error) as ex:
+            with DnsCache.lock:
+                old = DnsCache.cache.get(host)
+            if old and old["error"] is None and now - old["ts"] < DnsCache.stale_ttl:
+                # resolver is flaky: keep the last known address
+                Logger.debug("dns: Cannot resolve %s, keeping %s: %s" % (host, old["ip"], ex))
+                old["refreshing"] = False
+                return old
+            entry = {"ip": None, "error": ex, "ts": now, "expire": now + DnsCache.negative_ttl}
+            Logger.debug("dns: Cannot resolve %s: %s" % (host, ex))
+        entry["refreshing"] = False
+        entry["retry"] = 0
+        with DnsCache.lock:
+            DnsCache.cache[host] = entry
+        return entry
+
+    @staticmethod
+    def _refresh(host, entry):
+        # one refresh at a time, and a failed one is retried after negative_ttl
+        now = time.time()
+        with DnsCache.lock:
+            if entry["refreshing"] or now < entry["retry"]:
+                return
+            entry["refreshing"] = True
+            entry["retry"] = now + DnsCache.negative_ttl
+        start_daemon_thread(DnsCache._lookup, args=(host,))
+
+
 class PortTest(object):
     def test_lan(self, addr, source_ip=None, interface=None, info=False):
         print_status = Logger.info if info else Logger.debug
@@ -151,7 +223,7 @@ class PortTest(object):
                 interface   = interface,
                 timeout     = 8
             )
-            sock.connect(("ifconfig.co", 80))
+            sock.connect(DnsCache.resolve(("ifconfig.co", 80)))
             sock.sendall((
                 "GET /port/%d HTTP/1.0\r\n"
                 "Host: ifconfig.co\r\n"
@@ -186,7 +258,7 @@ class PortTest(object):
                 interface   = interface,
                 timeout     = 8
             )
-            sock.connect(("portcheck.transmissionbt.com", 80))
+            sock.connect(DnsCache.resolve(("portcheck.transmissionbt.com", 80)))
             sock.sendall((
                 "GET /%d HTTP/1.0\r\n"
                 "Host: portcheck.transmissionbt.com\r\n"
@@ -218,12 +290,109 @@ class PortTest(object):
             sock.close()
 
 
+class StunScoreboard(object):
+    # Health of STUN servers: smoothed RTT, successes, failures and the time
+    # of the last failure, optionally persisted to a JSON file so the fastest
+    # healthy servers are tried first across rechecks, retries and restarts.
+    def __init__(self, path=None):
+        self.path = path
+        self.servers = {}
+        self.default_rtt = 500      # ms, for servers without a record
+        self.cooldown = 300         # seconds a failed server stays demoted
+        self.alpha = 0.3            # weight of a new RTT sample
+        self.lock = threading.Lock()    # shared by the STUN clients of all mappings
+        if path:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as fin:
+                servers = json.load(fin)
+        except (OSError, IOError, ValueError) as ex:
+            self.servers = {}
+            if os.path.exists(self.path):
+                Logger.warning("stun: Cannot load scoreboard %s: %s" % (self.path, ex))
+            return
+        if not isinstance(servers, dict):
+            Logger.warning("stun: Cannot load scoreboard %s: not an object" % self.path)
+            servers = {}
+        # a bad record is dropped, the server then starts from the default score
+        self.servers = {}
+        for name, rec in servers.items():
+            if StunScoreboard._valid(rec):
+                self.servers[name] = rec
+            else:
+                Logger.warning("stun: Dropping bad scoreboard record of %s" % name)
+
+    @staticmethod
+    def _valid(rec):
+        number = (int, float)
+        try:
+            return (rec["rtt"] is None or isinstance(rec["rtt"], number)) and all(
+                isinstance(rec[key], number) for key in ("ok", "fail", "last_ok", "last_fail")
+            )
+        except (KeyError, TypeError, IndexError):
+            return False
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            with self.lock:
+                write_json_file(self.path, self.servers)
+        except (OSError, IOError) as ex:
+            Logger.warning("stun: Cannot save scoreboard %s: %s" % (self.path, ex))
+
+    def _get(self, server):
+        return self.servers.setdefault(addr_to_str(server), {
+            "rtt": None, "ok": 0, "fail": 0, "last_ok": 0, "last_fail": 0
+        })
+
+    def record_success(self, server, rtt):
+        ms = rtt * 1000
+        with self.lock:
+            rec = self._get(server)
+            rec["rtt"] = ms if rec["rtt"] is None else (1 - self.alpha) * rec["rtt"] + self.alpha * ms
+            rec["ok"] += 1
+            rec["last_ok"] = time.time()
+
+    def record_failure(self, server):
+        with self.lock:
+            rec = self._get(server)
+            rec["fail"] += 1
+            rec["last_fail"] = time.time()
+
+    def score(self, server):
+        # expected RTT divided by the (smoothed) success rate, lower is better
+        rec = self.servers.get(addr_to_str(server))
+        if not rec:
+            return self.default_rtt
+        rtt = self.default_rtt if rec["rtt"] is None else rec["rtt"]
+        score = rtt * (rec["ok"] + rec["fail"] + 2) / (rec["ok"] + 1)
+        if rec["last_fail"] > rec["last_ok"] and time.time() - rec["last_fail"] < self.cooldown:
+            score += 1000000
+        return score
+
+    def rank(self, servers):
+        return sorted(servers, key=self.score)
+
+
 class StunClient(object):
     class ServerUnavailable(Exception):
         pass
 
+    # ref: https://www.rfc-editor.org/rfc/rfc5389
+    MAGIC_COOKIE            = 0x2112a442
+    BINDING_REQUEST         = 0x0001
+    BINDING_RESPONSE        = 0x0101
+    BINDING_ERROR           = 0x0111
+    ATTR_MAPPED_ADDRESS     = 0x0001
+    ATTR_ERROR_CODE         = 0x0009
+    ATTR_XOR_MAPPED_ADDRESS = 0x0020
+    ATTR_XOR_MAPPED_OLD     = 0x8020    # pre-RFC servers (draft-ietf-behave)
+
     def __init__(self, stun_server_list, source_host="0.0.0.0", source_port=0,
-                 interface=None, udp=False):
+                 interface=None, udp=False, parallel=1, scoreboard=None):
         if not stun_server_list:
             raise ValueError("STUN server list is empty")
         self.stun_server_list = stun_server_list
@@ -231,8 +400,24 @@ class StunClient(object):
         self.source_port = source_port
         self.interface = interface
         self.udp = udp
+        self.parallel = parallel
+        self.scoreboard = scoreboard or StunScoreboard()
+        self.timeout = 3
+        self.udp_socks = {}
+
+    def __del__(self):
+        self.close()
 
     def get_mapping(self):
+        self.stun_server_list = self.scoreboard.rank(self.stun_server_list)
+        try:
+            if self.parallel > 1:
+                return self._get_mapping_parallel()
+            return self._get_mapping_sequential()
+        finally:
+            self.scoreboard.save()
+
+    def _get_mapping_sequential(self):
         first = self.stun_server_list[0]
         while True:
             try:
@@ -247,41 +432,350 @@ class StunClient(object):
                     # force sleep for 10 seconds, then try the next loop
                     time.sleep(10)
 
+    def _get_mapping_parallel(self):
+        # Probe `parallel` servers at once from the same source port and take
+        # the first valid answer; the next group is tried if none answers.
+        n = min(self.parallel, len(self.stun_server_list))
+        tried = 0
+        while True:
+            servers = self.stun_server_list[:n]
+            try:
+                inner_addr, results = self._probe(servers, 1)
+            except StunClient.ServerUnavailable as ex:
+                Logger.warning("stun: STUN servers %s are unavailable: %s" % (
+                    ", ".join(addr_to_uri(srv, udp=self.udp) for srv in servers), ex
+                ))
+                self.stun_server_list = self.stun_server_list[n:] + servers
+                tried += n
+                if tried >= len(self.stun_server_list):
+                    Logger.error("stun: No STUN server is available right now")
+                    tried = 0
+                    # force sleep for 10 seconds, then try the next loop
+                    time.sleep(10)
+                continue
+            server, outer_addr = results[0]
+            Logger.debug("stun: Got address %s from %s, source %s" % (
+                addr_to_uri(outer_addr, udp=self.udp),
+                addr_to_uri(server, udp=self.udp),
+                addr_to_uri(inner_addr, udp=self.udp)
+            ))
+            return inner_addr, outer_addr
+
+    def analyze(self, count=3):
+        # Query `count` servers at once from the same source port and compare
+        # the mapped addresses (RFC 4787 mapping behavior). Returns a dict
+        # with the NAT type, whether the mappings agree, and the most common
+        # mapping as inner/outer.
+        servers = self.scoreboard.rank(self.stun_server_list)[:max(count, 2)]
+        try:
+            inner_addr, results = self._probe(servers, len(servers))
+        except StunClient.ServerUnavailable as ex:
+            Logger.warning("stun: Cannot analyze NAT: %s" % ex)
+            inner_addr, outer_addr = self.get_mapping()
+            results = [(self.stun_server_list[0], outer_addr)]
+        finally:
+            self.scoreboard.save()
+        mapped = [outer_addr for _, outer_addr in results]
+        outer_addr = max(mapped, key=mapped.count)
+        if len(results) < 2:
+            nat_type = "unknown (only one STUN server answered)"
+        elif len(set(mapped)) == 1:
+            if outer_addr == inner_addr:
+                nat_type = "no NAT (public address)"
+            else:
+                nat_type = "endpoint-independent mapping (cone NAT)"
+        elif len(set(ip for ip, _ in mapped)) == 1:
+            nat_type = "endpoint-dependent mapping (symmetric NAT)"
+        else:
+            nat_type = "endpoint-dependent mapping (multiple public IPs)"
+        for server, addr in results:
+            Logger.debug("stun: %s maps %s to %s" % (
+                addr_to_uri(server, udp=self.udp),
+                addr_to_uri(inner_addr, udp=self.udp),
+                addr_to_uri(addr, udp=self.udp)
+            ))
+        return {
+            "type":         nat_type,
+            "consistent":   len(set(mapped)) == 1,
+            "servers":      len(results),
+            "inner":        inner_addr,
+            "outer":        outer_addr
+        }
+
+    def _probe(self, servers, want):
+        # returns (inner_addr, [(server, outer_addr), ...]) of at most `want`
+        # servers, in the order they answered
+        if self.udp:
+            return self._probe_udp(servers, want)
+        return self._probe_tcp(servers, want)
+
+    def _probe_udp(self, servers, want):
+        socks = {}
+        for server in servers:
+            try:
+                socks[self._udp_socket(server)] = server
+            except (OSError, socket.error) as ex:
+                Logger.debug("stun: Cannot reach %s: %s" % (addr_to_uri(server, udp=True), ex))
+                self.scoreboard.record_failure(server)
+        if not socks:
+            raise StunClient.ServerUnavailable("cannot connect")
+        requests = {sock: self._stun_request() for sock in socks}
+        ts = time.time()
+        deadline = ts + self.timeout
+        resend = 0
+        inner_addr = None
+        results = []
+        while requests and time.time() < deadline:
+            # UDP may lose packets: resend every second until answered
+            if time.time() >= resend:
+                for sock, (_, request) in requests.items():
+                    try:
+                        sock.send(request)
+                    except (OSError, socket.error):
+                        pass
+                resend = time.time() + 1
+            timeout = min(deadline, resend) - time.time()
+            for sock in select.select(list(requests), [], [], max(timeout, 0))[0]:
+                server = socks[sock]
+                txid = requests[sock][0]
+                try:
+                    buff = sock.recv(1500)
+                except BlockingIOError:
+                    continue
+                except (OSError, socket.error) as ex:
+                    # e.g. ICMP port unreachable, open a new socket next time
+                    Logger.debug("stun: %s: %s" % (addr_to_uri(server, udp=True), ex))
+                    self.scoreboard.record_failure(server)
+                    self._udp_socket_close(server)
+                    del requests[sock]
+                    continue
+                try:
+                    outer_addr = self._stun_parse(buff, txid)
+                except (ValueError, struct.error):
+                    # most likely a late answer to an earlier request
+                    continue
+                self.scoreboard.record_success(server, time.time() - ts)
+                del requests[sock]
+                inner_addr = inner_addr or sock.getsockname()
+                results.append((server, outer_addr))
+                if len(results) >= want:
+                    break
+                deadline = self._probe_deadline(deadline, ts, results)
+            if len(results) >= want:
+                break
+        if len(results) < want:
+            for sock in requests:
+                self.scoreboard.record_failure(socks[sock])
+        if not results:
+            raise StunClient.ServerUnavailable("timed out")
+        self.source_host, self.source_port = inner_addr
+        return inner_addr, results
+
+    def _udp_socket(self, server):
+        # One connected socket for each server, bound to the mapped port and
+        # kept open across rechecks. Being connected, it gets the answers of
+        # its server even when other sockets share the port.
+        server_addr = DnsCache.resolve(server)
+        entry = self.udp_socks.get(server)
+        if entry and entry[0] == server_addr:
+            return entry[1]
+        self._udp_socket_close(server)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            socket_set_opt(
+                sock,
+                reuse       = True,
+                bind_addr   = (self.source_host, self.source_port),
+                interface   = self.interface,
+                timeout     = 0
+            )
+            # the other sockets share the port picked by the first one
+            self.source_port = sock.getsockname()[1]
+            sock.connect(server_addr)
+        except Exception:
+            sock.close()
+            raise
+        self.udp_socks[server] = server_addr, sock
+        return sock
+
+    def _udp_socket_close(self, server):
+        entry = self.udp_socks.pop(server, None)
+        if entry:
+            entry[1].close()
+
+    def close(self):
+        for server in list(self.udp_socks):
+            self._udp_socket_close(server)
+
+    def _probe_tcp(self, servers, want):
+        sel = selectors.DefaultSelector()
+        socks = []
+        ts = time.time()
+        try:
+            for server in servers:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                socks.append(sock)
+                try:
+                    socket_set_opt(
+                        sock,
+                        reuse       = True,
+                        bind_addr   = (self.source_host, self.source_port),
+                        interface   = self.interface,
+                        timeout     = 0
+                    )
+                    # the other sockets share the port picked by the first one
+                    self.source_port = sock.getsockname()[1]
+                    err = sock.connect_ex(DnsCache.resolve(server))
+                except (OSError, socket.error):
+                    self.scoreboard.record_failure(server)
+                    continue
+                if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    sel.register(sock, selectors.EVENT_WRITE, [server, None])
+                else:
+                    self.scoreboard.record_failure(server)
+            if not sel.get_map():
+                raise StunClient.ServerUnavailable("cannot connect")
+            deadline = time.time() + self.timeout
+            inner_addr = None
+            results = []
+            while sel.get_map() and len(results) < want and time.time() < deadline:
+                for key, mask in sel.select(timeout=max(deadline - time.time(), 0)):
+                    sock, (server, txid) = key.fileobj, key.data
+                    try:
+                        if txid is None:
+                            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                            if err:
+                                raise OSError(err, os.strerror(err))
+                            txid, request = self._stun_request()
+                            sock.send(request)
+                            sel.modify(sock, selectors.EVENT_READ, [server, txid])
+                            continue
+                        outer_addr = self._stun_parse(sock.recv(1500), txid)
+                        self.scoreboard.record_success(server, time.time() - ts)
+                        inner_addr = inner_addr or sock.getsockname()
+                        results.append((server, outer_addr))
+                    except (OSError, ValueError, struct.error, socket.error):
+                        self.scoreboard.record_failure(server)
+                    sel.unregister(sock)
+                    if len(results) >= want:
+                        break
+                    deadline = self._probe_deadline(deadline, ts, results)
+            if len(results) < want:
+                for key in sel.get_map().values():
+                    self.scoreboard.record_failure(key.data[0])
+            if not results:
+                raise StunClient.ServerUnavailable("timed out")
+            self.source_host, self.source_port = inner_addr
+            return inner_addr, results
+        finally:
+            for sock in socks:
+                sock.close()
+            sel.close()
+
+    def _probe_deadline(self, deadline, ts, results):
+        # two answers are enough to compare, wait only a little for the rest
+        if len(results) < 2:
+            return deadline
+        now = time.time()
+        return min(deadline, now + max(now - ts, 0.5))
+
+    def _stun_request(self):
+        txid = struct.pack(
+            "!LLL", 0x4e415452, random.getrandbits(32), random.getrandbits(32)
+        )
+        return txid, struct.pack(
+            "!HHL", StunClient.BINDING_REQUEST, 0, StunClient.MAGIC_COOKIE
+        ) + txid
+
+    def _stun_parse(self, buff, txid):
+        # Decode a Binding response in place and return the mapped address,
+        # preferring XOR-MAPPED-ADDRESS. Raises ValueError if it is invalid.
+        view = memoryview(buff)
+        if len(view) < 20:
+            raise ValueError("STUN response is too short")
+        msg_type, msg_len, cookie = struct.unpack_from("!HHL", view, 0)
+        if cookie != StunClient.MAGIC_COOKIE:
+            raise ValueError("Invalid STUN magic cookie")
+        if view[8:20] != txid:
+            raise ValueError("Unexpected STUN transaction ID")
+        if msg_len % 4 or 20 + msg_len > len(view):
+            raise ValueError("Invalid STUN message length")
+        addrs = {}
+        offset = 20
+        end = 20 + msg_len
+        while offset + 4 <= end:
+            attr_type, attr_len = struct.unpack_from("!HH", view, offset)
+            value = view[offset + 4:offset + 4 + attr_len]
+            if len(value) < attr_len:
+                raise ValueError("Truncated STUN attribute")
+            if attr_type == StunClient.ATTR_ERROR_CODE and msg_type == StunClient.BINDING_ERROR:
+                cls_num = struct.unpack_from("!L", value, 0)[0] & 0x7ff
+                raise ValueError("STUN error %d: %s" % (
+                    (cls_num >> 8) * 100 + (cls_num & 0xff),
+                    bytes(value[4:]).decode("utf-8", "replace")
+                ))
+            if attr_type in (StunClient.ATTR_MAPPED_ADDRESS, StunClient.ATTR_XOR_MAPPED_ADDRESS,
+                             StunClient.ATTR_XOR_MAPPED_OLD):
+                addrs[attr_type] = value
+            # attributes are padded to a multiple of 4 bytes
+            offset += 4 + ((attr_len + 3) & ~3)
+        if msg_type != StunClient.BINDING_RESPONSE:
+            raise ValueError("Unexpected STUN message type 0x%04x" % msg_type)
+        for attr_type in (StunClient.ATTR_XOR_MAPPED_ADDRESS, StunClient.ATTR_XOR_MAPPED_OLD,
+                          StunClient.ATTR_MAPPED_ADDRESS):
+            if attr_type in addrs:
+                return self._stun_parse_addr(
+                    addrs[attr_type], txid, attr_type != StunClient.ATTR_MAPPED_ADDRESS
+                )
+        raise ValueError("Invalid STUN response")
+
+    def _stun_parse_addr(self, value, txid, xor):
+        _, family, port = struct.unpack_from("!BBH", value, 0)
+        if family == 0x01:
+            family, size = socket.AF_INET, 4
+        elif family == 0x02:
+            family, size = socket.AF_INET6, 16
+        else:
+            raise ValueError("Unknown address family %d in STUN response" % family)
+        if len(value) < 4 + size:
+            raise ValueError("Truncated STUN address")
+        ip = int.from_bytes(value[4:4 + size], "big")
+        if xor:
+            # X-Port is xored with the top of the cookie, X-Address with the
+            # cookie followed by the transaction ID (IPv6)
+            port ^= StunClient.MAGIC_COOKIE >> 16
+            key = struct.pack("!L", StunClient.MAGIC_COOKIE) + txid
+            ip ^= int.from_bytes(key[:size], "big")
+        return socket.inet_ntop(family, ip.to_bytes(size, "big")), port
+
     def _get_mapping(self):
-        # ref: https://www.rfc-editor.org/rfc/rfc5389
-        socket_type = socket.SOCK_DGRAM if self.udp else socket.SOCK_STREAM
+        if self.udp:
+            inner_addr, results = self._probe_udp(self.stun_server_list[:1], 1)
+            Logger.debug("stun: Got address %s from %s, source %s" % (
+                addr_to_uri(results[0][1], udp=True),
+                addr_to_uri(results[0][0], udp=True),
+                addr_to_uri(inner_addr, udp=True)
+            ))
+            return inner_addr, results[0][1]
         stun_host, stun_port = self.stun_server_list[0]
-        sock = socket.socket(socket.AF_INET, socket_type)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
             socket_set_opt(
                 sock,
                 reuse       = True,
                 bind_addr   = (self.source_host, self.source_port),
                 interface   = self.interface,
-                timeout     = 3
+                timeout     = self.timeout
             )
-            sock.connect((stun_host, stun_port))
+            ts = time.time()
+            sock.connect(DnsCache.resolve((stun_host, stun_port)))
             inner_addr = sock.getsockname()
             self.source_host, self.source_port = inner_addr
-            sock.send(struct.pack(
-                "!LLLLL", 0x00010000, 0x2112a442, 0x4e415452,
-                random.getrandbits(32), random.getrandbits(32)
-            ))
+            txid, request = self._stun_request()
+            sock.send(request)
             buff = sock.recv(1500)
-            ip = port = 0
-            payload = buff[20:]
-            while payload:
-                attr_type, attr_len = struct.unpack("!HH", payload[:4])
-                if attr_type in [1, 32]:
-                    _, _, port, ip = struct.unpack("!BBHL", payload[4:4+attr_len])
-                    if attr_type == 32:
-                        port ^= 0x2112
-                        ip ^= 0x2112a442
-                    break
-                payload = payload[4 + attr_len:]
-            else:
-                raise ValueError("Invalid STUN response")
-            outer_addr = socket.inet_ntop(socket.AF_INET, struct.pack("!L", ip)), port
+            outer_addr = self._stun_parse(buff, txid)
+            self.scoreboard.record_success((stun_host, stun_port), time.time() - ts)
             Logger.debug("stun: Got address %s from %s, source %s" % (
                 addr_to_uri(outer_addr, udp=self.udp),
                 addr_to_uri((stun_host, stun_port), udp=self.udp),
@@ -289,13 +783,15 @@ class StunClient(object):
             ))
             return inner_addr, outer_addr
         except (OSError, ValueError, struct.error, socket.error) as ex:
+            self.scoreboard.record_failure((stun_host, stun_port))
             raise StunClient.ServerUnavailable(ex)
         finally:
             sock.close()
 
 
 class KeepAlive(object):
-    def __init__(self, host, port, source_host, source_port, interface=None, udp=False):
+    def __init__(self, host, port, source_host, source_port, interface=None, udp=False,
+                 timeout=3):
         self.sock = None
         self.host = host
         self.port = port
@@ -303,6 +799,7 @@ class KeepAlive(object):
         self.source_port = source_port
         self.interface = interface
         self.udp = udp
+        self.timeout = timeout      # replies are read until it expires
         self.reconn = False
 
     def __del__(self):
@@ -318,9 +815,9 @@ class KeepAlive(object):
                 reuse       = True,
                 bind_addr   = (self.source_host, self.source_port),
                 interface   = self.interface,
-                timeout     = 3
+                timeout     = self.timeout
             )
-            self.sock.connect((self.host, self.port))
+            self.sock.connect(DnsCache.resolve((self.host, self.port)))
             if not self.udp:
                 Logger.debug("keep-alive: Connected to host %s" % (
                     addr_to_uri((self.host, self.port), udp=self.udp)
@@ -391,6 +888,200 @@ class KeepAlive(object):
             return
 
 
+class KeepAliveGroup(object):
+    # Keep-alive to several servers from the same bound port. Servers that
+    # failed least recently are tried first, and a failing one is replaced by
+    # the next right away, so one server outage does not break the keep-alive.
+    # With parallel > 1, that many servers get a heartbeat concurrently.
+    def __init__(self, servers, source_host, source_port, interface=None, udp=False,
+                 parallel=1, timeout=3):
+        if not servers:
+            raise ValueError("Keep-alive server list is empty")
+        self.servers = servers
+        self.members = [
+            KeepAlive(host, port, source_host, source_port, interface=interface, udp=udp,
+                      timeout=timeout)
+            for host, port in servers
+        ]
+        self.fails = [0] * len(servers)     # consecutive failures
+        self.parallel = max(1, min(parallel, len(servers)))
+        self.udp = udp
+
+    def keep_alive(self):
+        # stable sort: equally healthy servers keep the configured order
+        order = sorted(range(len(self.members)), key=lambda i: self.fails[i])
+        ok = 0
+        last_ex = None
+        while order and ok < self.parallel:
+            batch, order = order[:self.parallel - ok], order[self.parallel - ok:]
+            errors = self._beat(batch)
+            for i in batch:
+                ex = errors.get(i)
+                if ex is None:
+                    self.fails[i] = 0
+                    ok += 1
+                    continue
+                if hasattr(errno, "EADDRNOTAVAIL") and ex.errno == errno.EADDRNOTAVAIL:
+                    raise ex
+                self.fails[i] += 1
+                self.members[i].disconnect()
+                last_ex = ex
+                if len(self.members) > 1:
+                    Logger.warning("keep-alive: server %s failed (%d in a row): %s" % (
+                        addr_to_uri(self.servers[i], udp=self.udp), self.fails[i], ex
+                    ))
+        if not ok:
+            raise last_ex
+
+    def _beat(self, indexes):
+        errors = {}
+
+        def beat(i):
+            try:
+                self.members[i].keep_alive()
+            except (OSError, socket.error) as ex:
+                errors[i] = ex
+
+        threads = [start_daemon_thread(beat, args=(i,)) for i in indexes[1:]]
+        beat(indexes[0])
+        for th in threads:
+            th.join()
+        return errors
+
+    def disconnect(self):
+        for member in self.members:
+            member.disconnect()
+
+
+class KeepAliveTuner(object):
+    # Learn how long the NAT keeps an idle UDP mapping. A probe socket on its
+    # own port asks one STUN server for its mapping, stays idle for a doubling
+    # period and asks again; the mapping survived if the outer address did
+    # not change. The interval then settles at the longest period survived
+    # times `margin`. step() never blocks longer than one STUN round trip.
+    def __init__(self, server, interval, source_host="0.0.0.0", interface=None,
+                 max_interval=300, margin=0.5, on_settle=None):
+        self.server = server
+        self.interval = interval
+        self.max_interval = max_interval
+        self.margin = margin
+        self.on_settle = on_settle
+        self.stun = StunClient([server], source_host, 0, interface=interface, udp=True)
+        self.idle = interval * 2    # idle period being tested
+        self.alive = interval       # longest idle period survived
+        self.ts = None
+        self.outer_addr = None
+        self.done = False
+
+    def step(self):
+        if self.done:
+            return
+        if self.ts is not None and time.monotonic() - self.ts < self.idle:
+            return
+        try:
+            _, results = self.stun._probe_udp([self.server], 1)
+        except StunClient.ServerUnavailable as ex:
+            # start over: the idle period is only valid after a good answer
+            Logger.debug("keep-alive: tuning probe failed: %s" % ex)
+            self.ts = self.outer_addr = None
+            return
+        outer_addr = results[0][1]
+        if self.outer_addr is None:
+            Logger.debug("keep-alive: testing if mapping %s survives %d seconds idle" % (
+                addr_to_uri(outer_addr, udp=True), self.idle
+            ))
+        elif outer_addr != self.outer_addr:
+            Logger.debug("keep-alive: mapping %s expired within %d seconds" % (
+                addr_to_uri(self.outer_addr, udp=True), self.idle
+            ))
+            self._settle(self.alive * self.margin)
+            return
+        else:
+            self.alive = self.idle
+            if self.idle * 2 * self.margin > self.max_interval:
+                self._settle(self.max_interval)
+                return
+            self.idle *= 2
+            Logger.debug("keep-alive: mapping survived, testing %d seconds idle" % self.idle)
+        self.outer_addr = outer_addr
+        self.ts = time.monotonic()
+
+    def _settle(self, interval):
+        interval = int(max(min(interval, self.max_interval), self.interval))
+        Logger.info("keep-alive: NAT keeps idle UDP mappings for at least %d seconds, "
+                    "using %d seconds interval" % (self.alive, interval))
+        self.done = True
+        self.stun.close()
+        if self.on_settle:
+            self.on_settle(interval)
+
+
+class UdpBatch(object):
+    # Batched UDP I/O on Linux: with UDP_GRO one recvmsg() returns a run of
+    # equal-sized datagrams from one peer, and UDP_SEGMENT (GSO) sends such a
+    # run with one sendmsg(). Elsewhere this is plain recvfrom() / sendto().
+    SOL_UDP = getattr(socket, "SOL_UDP", 17)
+    UDP_SEGMENT = 103
+    UDP_GRO = 104
+    supported = sys.platform.startswith("linux") and hasattr(socket.socket, "sendmsg")
+
+    def __init__(self, buff_size=65535):
+        self.view = memoryview(bytearray(buff_size))
+        self.bufs = [self.view]
+        self.gso = UdpBatch.supported
+        self.cmsg_size = socket.CMSG_SPACE(4) if UdpBatch.supported else 0
+
+    def enable_gro(self, sock):
+        if not UdpBatch.supported:
+            return False
+        try:
+            sock.setsockopt(UdpBatch.SOL_UDP, UdpBatch.UDP_GRO, 1)
+            return True
+        except (OSError, socket.error):
+            return False
+
+    def recv(self, sock):
+        # returns (data, addr, segment size); segment size is 0 unless
+        # data holds several datagrams
+        if not UdpBatch.supported:
+            n, addr = sock.recvfrom_into(self.view)
+            return self.view[:n], addr, 0
+        n, ancdata, _, addr = sock.recvmsg_into(self.bufs, self.cmsg_size)
+        if not ancdata:
+            return self.view[:n], addr, 0
+        seg = 0
+        for level, type_, data in ancdata:
+            if level == UdpBatch.SOL_UDP and type_ == UdpBatch.UDP_GRO:
+                seg = int.from_bytes(data, sys.byteorder)
+        if seg >= n:
+            seg = 0
+        return self.view[:n], addr, seg
+
+    def send(self, sock, data, seg=0, addr=None):
+        # returns the number of datagrams sent
+        if not seg:
+            if addr:
+                sock.sendto(data, addr)
+            else:
+                sock.send(data)
+            return 1
+        if self.gso:
+            try:
+                sock.sendmsg(
+                    [data], [(UdpBatch.SOL_UDP, UdpBatch.UDP_SEGMENT, struct.pack("=H", seg))],
+                    0, *((addr,) if addr else ())
+                )
+                return -(-len(data) // seg)
+            except (OSError, socket.error) as ex:
+                if ex.errno not in (errno.EINVAL, errno.EIO, errno.ENOPROTOOPT):
+                    raise
+                Logger.debug("udp-batch: UDP GSO is not available: %s" % ex)
+                self.gso = False
+        for i in range(0, len(data), seg):
+            self.send(sock, data[i:i + seg], addr=addr)
+        return -(-len(data) // seg)
+
+
 class ForwardNone(object):
     # Do nothing. Don't forward.
     def start_forward(self, ip, port, toip, toport, udp=False):
@@ -405,6 +1096,8 @@ class ForwardTestServer(object):
         self.sock = None
         self.buff_size = 8192
         self.timeout = 3
+        self.rcvbuf = None
+        self.sndbuf = None
 
     def __del__(self):
         self.stop_forward()
@@ -418,7 +1111,9 @@ class ForwardTestServer(object):
             socket_set_opt(
                 self.sock,
                 reuse       = True,
-                bind_addr   = ("", port)
+                bind_addr   = ("", port),
+                rcvbuf      = self.rcvbuf,
+                sndbuf      = self.sndbuf
             )
             Logger.debug("fwd-test: Starting test server at %s" %
                          addr_to_uri((ip, port), udp=udp))
@@ -464,11 +1159,18 @@ class ForwardTestServer(object):
                 conn.close()
 
     def _test_server_run_udp(self):
+        batch = UdpBatch(65535)
+        batch.enable_gro(self.sock)
+        reply = b"It works! - Natter\r\n"
         while self.sock and self.sock.fileno() != -1:
             try:
-                msg, addr = self.sock.recvfrom(self.buff_size)
+                msg, addr, seg = batch.recv(self.sock)
                 Logger.debug("fwd-test: got client %s" % (addr,))
-                self.sock.sendto(b"It works! - Natter\r\n", addr)
+                if seg:
+                    # one reply per coalesced datagram, sent in one batch
+                    batch.send(self.sock, reply * -(-len(msg) // seg), len(reply), addr)
+                else:
+                    batch.send(self.sock, reply, addr=addr)
             except (OSError, socket.error):
                 return
 
@@ -480,35 +1182,54 @@ class ForwardTestServer(object):
 
 
 class ForwardIptables(object):
-    def __init__(self, snat=False, sudo=False):
+    # With iptables-save/iptables-restore available, the current nat table is
+    # read once and every change set (chains, DNAT + SNAT rules, cleanup) is
+    # applied as one atomic `iptables-restore --noflush` transaction, instead
+    # of one iptables process (and xtables lock) per rule.
+    def __init__(self, snat=False, sudo=False, use_restore=True):
         self.rules = []
         self.min_ver = (1, 4, 1)
         self.curr_ver = (0, 0, 0)
         self.snat = snat
         self.sudo = sudo
-        if sudo:
-            self.iptables_cmd = ["sudo", "-n", "iptables"]
-        else:
-            self.iptables_cmd = ["iptables"]
+        self.use_restore = use_restore
+        self.nat_table = ""
+        self.forks = 0
+        self.fork_time = 0
+        prefix = ["sudo", "-n"] if sudo else []
+        self.iptables_cmd = prefix + ["iptables"]
+        self.save_cmd = prefix + ["iptables-save", "-t", "nat"]
+        self.restore_cmd = prefix + ["iptables-restore", "--noflush"]
         if not self._iptables_check():
             raise OSError("iptables >= %s not available" % str(self.min_ver))
         # wait for iptables lock, since iptables 1.4.20
         if self.curr_ver >= (1, 4, 20):
             self.iptables_cmd += ["-w"]
+        # iptables-restore waits for the lock since iptables 1.6.2
+        if self.curr_ver >= (1, 6, 2):
+            self.restore_cmd += ["-w"]
         self._iptables_init()
 
     def __del__(self):
         self.stop_forward()
 
+    def _run(self, cmd, input=None):
+        ts = time.time()
+        try:
+            return subprocess.check_output(
+                cmd, input=input.encode() if input else None, stderr=subprocess.STDOUT
+            ).decode()
+        finally:
+            self.forks += 1
+            self.fork_time += time.time() - ts
+
     def _iptables_check(self):
         if os.name != "posix":
             return False
         if not self.sudo and os.getuid() != 0:
             Logger.warning("fwd-iptables: You are not root")
         try:
-            output = subprocess.check_output(
-                self.iptables_cmd + ["--version"]
-            ).decode()
+            output = self._run(self.iptables_cmd + ["--version"])
         except (OSError, subprocess.CalledProcessError) as e:
             return False
         m = re.search(r"iptables v([0-9]+)\.([0-9]+)\.([0-9]+)", output)
@@ -519,53 +1240,86 @@ class ForwardIptables(object):
                 return False
         else:
             return False
-        # check nat table
+        # check nat table, iptables-save also tells what is there already
+        if self.use_restore:
+            try:
+                self.nat_table = self._run(self.save_cmd)
+                return True
+            except (OSError, subprocess.CalledProcessError) as e:
+                Logger.debug("fwd-iptables: iptables-save is not usable, batching is off: %s" % e)
+                self.use_restore = False
         try:
-            subprocess.check_output(
-                self.iptables_cmd + ["-t", "nat", "--list-rules"]
-            )
+            self._run(self.iptables_cmd + ["-t", "nat", "--list-rules"])
         except (OSError, subprocess.CalledProcessError) as e:
             return False
         return True
 
     def _iptables_init(self):
+        if self.use_restore:
+            self._iptables_init_restore()
+            return
         try:
-            subprocess.check_output(
-                self.iptables_cmd + ["-t", "nat", "--list-rules", "NATTER"],
-                stderr=subprocess.STDOUT
-            )
+            self._run(self.iptables_cmd + ["-t", "nat", "--list-rules", "NATTER"])
             return
         except subprocess.CalledProcessError:
             pass
         Logger.debug("fwd-iptables: Creating Natter chain")
-        subprocess.check_output(
-            self.iptables_cmd + ["-t", "nat", "-N", "NATTER"]
-        )
-        subprocess.check_output(
-            self.iptables_cmd + ["-t", "nat", "-I", "PREROUTING", "-j", "NATTER"]
-        )
-        subprocess.check_output(
-            self.iptables_cmd + ["-t", "nat", "-I", "OUTPUT", "-j", "NATTER"]
-        )
-        subprocess.check_output(
-            self.iptables_cmd + ["-t", "nat", "-N", "NATTER_SNAT"]
-        )
-        subprocess.check_output(
-            self.iptables_cmd + ["-t", "nat", "-I", "POSTROUTING", "-j", "NATTER_SNAT"]
-        )
-        subprocess.check_output(
-            self.iptables_cmd + ["-t", "nat", "-I", "INPUT", "-j", "NATTER_SNAT"]
-        )
+        self._run(self.iptables_cmd + ["-t", "nat", "-N", "NATTER"])
+        self._run(self.iptables_cmd + ["-t", "nat", "-I", "PREROUTING", "-j", "NATTER"])
+        self._run(self.iptables_cmd + ["-t", "nat", "-I", "OUTPUT", "-j", "NATTER"])
+        self._run(self.iptables_cmd + ["-t", "nat", "-N", "NATTER_SNAT"])
+        self._run(self.iptables_cmd + ["-t", "nat", "-I", "POSTROUTING", "-j", "NATTER_SNAT"])
+        self._run(self.iptables_cmd + ["-t", "nat", "-I", "INPUT", "-j", "NATTER_SNAT"])
+
+    def _iptables_init_restore(self):
+        # only add what is missing: declaring an existing chain in
+        # iptables-restore would flush the rules of other Natter instances
+        existing = set(line.strip() for line in self.nat_table.splitlines())
+        chains = [c for c in ("NATTER", "NATTER_SNAT") if not any(
+            line.startswith(":%s " % c) for line in existing
+        )]
+        jumps = [
+            ["-I", builtin, "-j", chain] for builtin, chain in (
+                ("PREROUTING", "NATTER"), ("OUTPUT", "NATTER"),
+                ("POSTROUTING", "NATTER_SNAT"), ("INPUT", "NATTER_SNAT")
+            ) if "-A %s -j %s" % (builtin, chain) not in existing
+        ]
+        if not chains and not jumps:
+            return
+        Logger.debug("fwd-iptables: Creating Natter chain")
+        self._iptables_restore(jumps, chains)
+
+    def _iptables_restore(self, rules, chains=()):
+        # all rules are in the nat table, "-t nat" is given by "*nat"
+        lines = ["*nat"]
+        lines += [":%s - [0:0]" % chain for chain in chains]
+        for rule in rules:
+            args = list(rule)
+            if "-t" in args:
+                i = args.index("-t")
+                del args[i:i + 2]
+            lines.append(" ".join(args))
+        lines.append("COMMIT")
+        self._run(self.restore_cmd, input="\n".join(lines) + "\n")
 
     def _iptables_clean(self):
+        if self.use_restore and self.rules:
+            rules_rm = [
+                ["-D" if arg in ("-I", "-A") else arg for arg in rule]
+                for rule in reversed(self.rules)
+            ]
+            try:
+                self._iptables_restore(rules_rm)
+                self.rules = []
+                return
+            except (OSError, subprocess.CalledProcessError) as ex:
+                # e.g. a rule was already deleted by someone else
+                Logger.debug("fwd-iptables: Batched cleanup failed, deleting one by one: %s" % ex)
         while self.rules:
             rule = self.rules.pop()
             rule_rm = ["-D" if arg in ("-I", "-A") else arg for arg in rule]
             try:
-                subprocess.check_output(
-                    self.iptables_cmd + rule_rm,
-                    stderr=subprocess.STDOUT
-                )
+                self._run(self.iptables_cmd + rule_rm)
             except subprocess.CalledProcessError as ex:
                 Logger.error("fwd-iptables: Failed to execute %s: %s" % (ex.cmd, ex.output))
                 continue
@@ -579,36 +1333,75 @@ class ForwardIptables(object):
         Logger.debug("fwd-iptables: Adding rule %s forward to %s" % (
             addr_to_uri((ip, port), udp=udp), addr_to_uri((toip, toport), udp=udp)
         ))
-        try:
-            rule = [
-                "-t",       "nat",
-                "-I",       "NATTER",
-                "-p",       proto,
-                "--dst",    ip,
-                "--dport",  "%d" % port,
-                "-j",       "DNAT",
-                "--to-destination", "%s:%d" % (toip, toport)
-            ]
-            subprocess.check_output(self.iptables_cmd + rule)
-            self.rules.append(rule)
-            if self.snat:
-                rule = [
-                    "-t",       "nat",
-                    "-I",       "NATTER_SNAT",
-                    "-p",       proto,
-                    "--dst",    toip,
-                    "--dport",  "%d" % toport,
-                    "-j",       "SNAT",
-                    "--to-source", ip
-                ]
-                subprocess.check_output(self.iptables_cmd + rule)
-                self.rules.append(rule)
-        except Exception:
+        rules = self._iptables_rules(ip, port, toip, toport, proto)
+        if self.use_restore:
+            # atomic: either all rules are added or none
+            self._iptables_restore(rules)
+            self.rules += rules
+        else:
             try:
-                self._iptables_clean()
+                for rule in rules:
+                    self._run(self.iptables_cmd + rule)
+                    self.rules.append(rule)
             except Exception:
-                pass
-            raise
+                try:
+                    self._iptables_clean()
+                except Exception:
+                    pass
+                raise
+        Logger.debug("fwd-iptables: %d commands run in %.1f ms so far" % (
+            self.forks, self.fork_time * 1000
+        ))
+
+    def update_forward(self, ip, port, toip, toport, udp=False):
+        # point the forwarding of ip:port to a new target, keeping the other
+        # forwardings and the established connections
+        if ip != toip:
+            self._check_sys_forward_config()
+        proto = "udp" if udp else "tcp"
+        rules_old = None
+        for rule in self.rules:
+            if rule[rule.index("-j") + 1] == "DNAT" and rule[rule.index("-p") + 1] == proto and \
+                    rule[rule.index("--dst") + 1] == ip and rule[rule.index("--dport") + 1] == "%d" % port:
+                old_toip, old_toport = rule[rule.index("--to-destination") + 1].rsplit(":", 1)
+                rules_old = self._iptables_rules(ip, port, old_toip, int(old_toport), proto)
+                break
+        if not rules_old:
+            raise ValueError("No forwarding from %s" % addr_to_uri((ip, port), udp=udp))
+        Logger.debug("fwd-iptables: Updating rule %s forward to %s" % (
+            addr_to_uri((ip, port), udp=udp), addr_to_uri((toip, toport), udp=udp)
+        ))
+        rules = self._iptables_rules(ip, port, toip, toport, proto)
+        rules_rm = [["-D" if arg == "-I" else arg for arg in rule] for rule in rules_old]
+        if self.use_restore:
+            # atomic: no packet sees both or neither of the targets
+            self._iptables_restore(rules_rm + rules)
+        else:
+            for rule in rules_rm + rules:
+                self._run(self.iptables_cmd + rule)
+        self.rules = [rule for rule in self.rules if rule not in rules_old] + rules
+
+    def _iptables_rules(self, ip, port, toip, toport, proto):
+        rules = [[
+            "-t",       "nat",
+            "-I",       "NATTER",
+            "-p",       proto,
+            "--dst",    ip,
+            "--dport",  "%d" % port,
+            "-j",       "DNAT",
+            "--to-destination", "%s:%d" % (toip, toport)
+        ]]
+        if self.snat:
+            rules.append([
+                "-t",       "nat",
+                "-I",       "NATTER_SNAT",
+                "-p",       proto,
+                "--dst",    toip,
+                "--dport",  "%d" % toport,
+                "-j",       "SNAT",
+                "--to-source", ip
+            ])
+        return rules
 
     def stop_forward(self):
         Logger.debug("fwd-iptables: Cleaning up Natter rules")
@@ -642,10 +1435,20 @@ class ForwardSudoIptablesSnat(ForwardIptables):
 
 
 class ForwardNftables(object):
+    # Forwardings are elements of nftables maps keyed by address and port,
+    # looked up by static rules, so that every change is one atomic
+    # `nft -f -` transaction of element updates, without rule handles.
+    MAPS = {
+        "natter_dnat_tcp": "ipv4_addr . inet_service : ipv4_addr . inet_service",
+        "natter_dnat_udp": "ipv4_addr . inet_service : ipv4_addr . inet_service",
+        "natter_snat_tcp": "ipv4_addr . inet_service : ipv4_addr",
+        "natter_snat_udp": "ipv4_addr . inet_service : ipv4_addr"
+    }
+
     def __init__(self, snat=False, sudo=False):
-        self.handle = -1
-        self.handle_snat = -1
-        self.min_ver = (0, 9, 6)
+        self.elements = []      # (map, key, value) added by this instance
+        # `dnat to ... map` with address . port data, see _nftables_maps()
+        self.min_ver = (1, 0, 2)
         self.snat = snat
         self.sudo = sudo
         if sudo:
@@ -677,61 +1480,132 @@ class ForwardNftables(object):
             return curr_ver >= self.min_ver
         return False
 
+    def _nftables_run(self, script):
+        # one nft process, one transaction: all of script or nothing
+        subprocess.check_output(
+            self.nftables_cmd + ["-f", "-"], input=script.encode(), stderr=subprocess.STDOUT
+        )
+
     def _nftables_init(self):
         try:
-            subprocess.check_output(
+            output = subprocess.check_output(
                 self.nftables_cmd + ["list table ip natter"],
                 stderr=subprocess.STDOUT
-            )
-            return
+            ).decode()
         except subprocess.CalledProcessError:
-            pass
-        initial_rules = (
-            '''
-            table ip natter {
-                chain natter_dnat { }
-                chain natter_snat { }
-                chain prerouting {
-                    type nat hook prerouting priority dstnat-5; policy accept;
-                    jump natter_dnat;
-                }
-                chain output {
-                    type nat hook output priority dstnat-5; policy accept;
-                    jump natter_dnat;
-                }
-                chain postrouting {
-                    type nat hook postrouting priority srcnat-5; policy accept;
-                    jump natter_snat;
-                }
-                chain input {
-                    type nat hook input priority srcnat-5; policy accept;
-                    jump natter_snat;
+            output = None
+        try:
+            self._nftables_init_table(output)
+        except subprocess.CalledProcessError as ex:
+            # e.g. a kernel without NAT to concatenated address and port
+            raise OSError("nftables cannot load the Natter maps: %s" % (
+                ex.output.decode(errors="replace").strip()
+            ))
+
+    def _nftables_init_table(self, output):
+        if output is None:
+            Logger.debug("fwd-nftables: Creating Natter table")
+            self._nftables_run(
+                '''
+                table ip natter {
+                    chain natter_dnat { }
+                    chain natter_snat { }
+                    chain prerouting {
+                        type nat hook prerouting priority dstnat-5; policy accept;
+                        jump natter_dnat;
+                    }
+                    chain output {
+                        type nat hook output priority dstnat-5; policy accept;
+                        jump natter_dnat;
+                    }
+                    chain postrouting {
+                        type nat hook postrouting priority srcnat-5; policy accept;
+                        jump natter_snat;
+                    }
+                    chain input {
+                        type nat hook input priority srcnat-5; policy accept;
+                        jump natter_snat;
+                    }
                 }
-            }
-            '''
-        )
-        Logger.debug("fwd-nftables: Creating Natter table")
-        subprocess.check_output(
-            self.nftables_cmd + [initial_rules]
-        )
+                ''' + self._nftables_maps()
+            )
+        elif "map natter_dnat_tcp" not in output:
+            # table of an older Natter, using one rule per forwarding
+            Logger.debug("fwd-nftables: Adding Natter maps")
+            self._nftables_run(self._nftables_maps())
+
+    def _nftables_maps(self):
+        script = ""
+        for name, map_type in ForwardNftables.MAPS.items():
+            script += "add map ip natter %s { type %s; }\n" % (name, map_type)
+        for proto in ("tcp", "udp"):
+            script += (
+                "add rule ip natter natter_dnat meta l4proto %s "
+                "dnat to ip daddr . %s dport map @natter_dnat_%s\n" % (proto, proto, proto)
+            )
+            script += (
+                "add rule ip natter natter_snat meta l4proto %s "
+                "snat to ip daddr . %s dport map @natter_snat_%s\n" % (proto, proto, proto)
+            )
+        return script
 
     def _nftables_clean(self):
         Logger.debug("fwd-nftables: Cleaning up Natter rules")
-        if self.handle > 0:
-            subprocess.check_output(
-                self.nftables_cmd + [
-                    "delete rule ip natter natter_dnat handle %d" % self.handle
-                ]
+        if not self.elements:
+            return
+        self._nftables_run(self._nftables_delete(self.elements))
+        self.elements = []
+
+    def _nftables_delete(self, elements):
+        return "".join(
+            "delete element ip natter %s { %s }\n" % (name, key)
+            for name, key, value in elements
+        )
+
+    def _nftables_add(self, elements, elements_old=()):
+        # Add elements, swapping out elements_old in the same transaction.
+        # An element with the same key but other data (e.g. left behind by a
+        # crashed Natter) makes `add element` fail; it is looked up only then,
+        # and deleted in the retried transaction.
+        def script(stale):
+            return self._nftables_delete(list(elements_old) + stale) + "".join(
+                "add element ip natter %s { %s : %s }\n" % elem for elem in elements
             )
-            self.handle = -1
-        if self.handle_snat > 0:
-            subprocess.check_output(
-                self.nftables_cmd + [
-                    "delete rule ip natter natter_snat handle %d"
-                        % self.handle_snat
-                ]
+        try:
+            self._nftables_run(script([]))
+        except subprocess.CalledProcessError:
+            stale = self._nftables_stale(elements, elements_old)
+            if not stale:
+                raise
+            Logger.warning("fwd-nftables: Replacing stale elements %s" % (
+                ", ".join("%s { %s : %s }" % elem for elem in stale)
+            ))
+            self._nftables_run(script(stale))
+
+    def _nftables_stale(self, elements, elements_old=()):
+        deleted = set((name, key) for name, key, value in elements_old)
+        stale = []
+        for name, key, value in elements:
+            if (name, key) in deleted:
+                continue
+            output = subprocess.check_output(
+                self.nftables_cmd + ["list map ip natter %s" % name],
+                stderr=subprocess.STDOUT
+            ).decode()
+            m = re.search(r"(?:^|[\s{,])%s : ([^,}\n]+)" % re.escape(key), output)
+            if m:
+                stale.append((name, key, m.group(1).strip()))
+        return stale
+
+    def _nftables_elements(self, ip, port, toip, toport, proto):
+        elements = [
+            ("natter_dnat_%s" % proto, "%s . %d" % (ip, port), "%s . %d" % (toip, toport))
+        ]
+        if self.snat:
+            elements.append(
+                ("natter_snat_%s" % proto, "%s . %d" % (toip, toport), ip)
             )
-            self.handle_snat = -1
+        return elements
 
     def start_forward(self, ip, port, toip, toport, udp=False):
         if ip != toip:
@@ -744,36 +1618,37 @@ class ForwardNftables(object):
             addr_to_uri((ip, port), udp=udp),
             addr_to_uri((toip, toport), udp=udp)
         ))
-        try:
-            output = subprocess.check_output(self.nftables_cmd + [
-                "--echo", "--handle",
-                "insert rule ip natter natter_dnat ip daddr %s %s dport %d "
-                "dnat to %s:%d" % (
-                    ip, proto, port, toip, toport
-                )
-            ]).decode()
-            m = re.search(r"# handle ([0-9]+)", output)
-            if not m:
-                raise ValueError("Unknown nftables handle")
-            self.handle = int(m.group(1))
-            if self.snat:
-                output = subprocess.check_output(self.nftables_cmd + [
-                    "--echo", "--handle",
-                    "insert rule ip natter natter_snat ip daddr %s "
-                    "%s dport %d snat to %s" % (
-                        toip, proto, toport, ip
-                    )
-                ]).decode()
-                m = re.search(r"# handle ([0-9]+)", output)
-                if not m:
-                    raise ValueError("Unknown nftables handle")
-                self.handle_snat = int(m.group(1))
-        except Exception:
-            try:
-                self._nftables_clean()
-            except Exception:
-                pass
-            raise
+        elements = self._nftables_elements(ip, port, toip, toport, proto)
+        # a forwarding of the same key is replaced in the same transaction,
+        # the others of this instance are kept
+        keys = set((name, key) for name, key, value in elements)
+        elements_old = [elem for elem in self.elements if elem[:2] in keys]
+        self._nftables_add(elements, elements_old)
+        self.elements = [elem for elem in self.elements if elem not in elements_old] + elements
+
+    def update_forward(self, ip, port, toip, toport, udp=False):
+        # point the forwarding of ip:port to a new target, keeping the other
+        # forwardings and the established connections
+        if ip != toip:
+            self._check_sys_forward_config()
+        proto = "udp" if udp else "tcp"
+        key = "%s . %d" % (ip, port)
+        elements_old = None
+        for name, elem_key, value in self.elements:
+            if name == "natter_dnat_%s" % proto and elem_key == key:
+                old_toip, old_toport = value.split(" . ")
+                elements_old = self._nftables_elements(ip, port, old_toip, int(old_toport), proto)
+                break
+        if not elements_old:
+            raise ValueError("No forwarding from %s" % addr_to_uri((ip, port), udp=udp))
+        Logger.debug("fwd-nftables: Updating rule %s forward to %s" % (
+            addr_to_uri((ip, port), udp=udp),
+            addr_to_uri((toip, toport), udp=udp)
+        ))
+        elements = self._nftables_elements(ip, port, toip, toport, proto)
+        # the old target is swapped for the new one in the same transaction
+        self._nftables_add(elements, elements_old)
+        self.elements = [elem for elem in self.elements if elem not in elements_old] + elements
 
     def stop_forward(self):
         self._nftables_clean()
@@ -805,17 +1680,134 @@ class ForwardSudoNftablesSnat(ForwardNftables):
         super().__init__(snat=True, sudo=True)
 
 
-class ForwardGost(object):
+class ForwardProcess(object):
+    # Base of the methods forwarding through an external program. A thread
+    # waits for the child (waitpid) and restarts it with exponential backoff
+    # when it dies. A start is done when the port is listening, not after a
+    # fixed sleep. Subclasses give the name and _command() of the program.
+    name = None
+
     def __init__(self):
-        self.min_ver = (2, 3)
         self.proc = None
-        self.udp_timeout = 60
-        if not self._gost_check():
-            raise OSError("gost >= %s not available" % str(self.min_ver))
+        self.args = None
+        self.started = 0
+        self.restarts = 0
+        self.last_exit = None
+        self.ready_timeout = 5
+        self.backoff_min = 1
+        self.backoff_max = 30
+        self.stable_time = 60       # seconds up after which the backoff is reset
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()    # a new one for every start
 
     def __del__(self):
         self.stop_forward()
 
+    def start_forward(self, ip, port, toip, toport, udp=False):
+        if (ip, port) == (toip, toport):
+            raise ValueError("Cannot forward to the same address %s" %
+                             addr_to_str((ip, port)))
+        Logger.debug("fwd-%s: Starting %s %s forward to %s" % (
+            self.name, self.name,
+            addr_to_uri((ip, port), udp=udp),
+            addr_to_uri((toip, toport), udp=udp)
+        ))
+        self.args = (ip, port, toip, toport, udp)
+        with self.lock:
+            self._spawn()
+            self.stopped = threading.Event()
+        start_daemon_thread(self._supervise, args=(self.stopped,))
+
+    def _spawn(self):
+        # own session: a Ctrl-C meant for Natter must not look like a crash,
+        # Natter stops the child itself
+        self.proc = subprocess.Popen(self._command(*self.args), start_new_session=True)
+        self.started = time.monotonic()
+        try:
+            self._wait_ready()
+        except Exception:
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+            raise
+
+    def _wait_ready(self):
+        port, udp = self.args[1], self.args[4]
+        deadline = self.started + self.ready_timeout
+        while True:
+            if self.proc.poll() is not None:
+                raise OSError("%s exited too quickly" % self.name)
+            listening = port_listening(port, udp)
+            if listening is None:
+                # cannot probe here, give it the time it used to get
+                time.sleep(1)
+                if self.proc.poll() is not None:
+                    raise OSError("%s exited too quickly" % self.name)
+                return
+            if listening:
+                Logger.debug("fwd-%s: Listening after %.0f ms" % (
+                    self.name, (time.monotonic() - self.started) * 1000
+                ))
+                return
+            if time.monotonic() > deadline:
+                raise OSError("%s is not listening on port %d" % (self.name, port))
+            time.sleep(0.05)
+
+    def _supervise(self, stopped):
+        backoff = self.backoff_min
+        while not stopped.is_set():
+            proc = self.proc
+            if proc:
+                code = proc.wait()
+                if stopped.is_set():
+                    return
+                self.last_exit = code
+                uptime = time.monotonic() - self.started
+                if uptime > self.stable_time:
+                    backoff = self.backoff_min
+                Logger.error("fwd-%s: %s exited with code %d after %.0f seconds, restarting in %d seconds" % (
+                    self.name, self.name, code, uptime, backoff
+                ))
+            if stopped.wait(backoff):
+                return
+            backoff = min(backoff * 2, self.backoff_max)
+            with self.lock:
+                if stopped.is_set():
+                    return
+                self.restarts += 1
+                try:
+                    self._spawn()
+                except (OSError, ValueError) as ex:
+                    Logger.error("fwd-%s: Cannot restart %s: %s" % (self.name, self.name, ex))
+
+    def stats(self):
+        return {
+            "processes":    1 if self.proc and self.proc.poll() is None else 0,
+            "restarts":     self.restarts
+        }
+
+    def stop_forward(self):
+        with self.lock:
+            self.stopped.set()
+            if not self.proc:
+                return
+            Logger.debug("fwd-%s: Stopping %s" % (self.name, self.name))
+            if self.proc.poll() is None:
+                self.proc.terminate()
+            self.proc.wait()
+            self.proc = None
+
+
+class ForwardGost(ForwardProcess):
+    name = "gost"
+
+    def __init__(self):
+        super().__init__()
+        self.min_ver = (2, 3)
+        self.udp_timeout = 60
+        if not self._gost_check():
+            raise OSError("gost >= %s not available" % str(self.min_ver))
+
     def _gost_check(self):
         try:
             output = subprocess.check_output(
@@ -830,50 +1822,25 @@ class ForwardGost(object):
             return current_ver >= self.min_ver
         return False
 
-    def start_forward(self, ip, port, toip, toport, udp=False):
-        if (ip, port) == (toip, toport):
-            raise ValueError("Cannot forward to the same address %s" %
-                             addr_to_str((ip, port)))
+    def _command(self, ip, port, toip, toport, udp):
         proto = "udp" if udp else "tcp"
-        Logger.debug("fwd-gost: Starting gost %s forward to %s" % (
-            addr_to_uri((ip, port), udp=udp),
-            addr_to_uri((toip, toport), udp=udp)
-        ))
         gost_arg = "-L=%s://:%d/%s:%d" % (proto, port, toip, toport)
         if udp:
             gost_arg += "?ttl=%ds" % self.udp_timeout
-        self.proc = subprocess.Popen(["gost", gost_arg])
-        try:
-            time.sleep(1)
-            if self.proc.poll() is not None:
-                raise OSError("gost exited too quickly")
-        except Exception:
-            self.proc.kill()
-            self.proc.wait()
-            self.proc = None
-            raise
+        return ["gost", gost_arg]
 
-    def stop_forward(self):
-        Logger.debug("fwd-gost: Stopping gost")
-        if self.proc and self.proc.poll() is not None:
-            return
-        self.proc.terminate()
-        self.proc.wait()
-        self.proc = None
 
+class ForwardSocat(ForwardProcess):
+    name = "socat"
 
-class ForwardSocat(object):
     def __init__(self):
+        super().__init__()
         self.min_ver = (1, 7, 2)
-        self.proc = None
         self.udp_timeout = 60
         self.max_children = 128
         if not self._socat_check():
             raise OSError("socat >= %s not available" % str(self.min_ver))
 
-    def __del__(self):
-        self.stop_forward()
-
     def _socat_check(self):
         try:
             output = subprocess.check_output(
@@ -888,48 +1855,337 @@ class ForwardSocat(object):
             return current_ver >= self.min_ver
         return False
 
-    def start_forward(self, ip, port, toip, toport, udp=False):
-        if (ip, port) == (toip, toport):
-            raise ValueError("Cannot forward to the same address %s" % addr_to_str((ip, port)))
+    def _command(self, ip, port, toip, toport, udp):
         proto = "UDP" if udp else "TCP"
-        Logger.debug("fwd-socat: Starting socat %s forward to %s" % (
-            addr_to_uri((ip, port), udp=udp), addr_to_uri((toip, toport), udp=udp)
-        ))
         if udp:
             socat_cmd = ["socat", "-T%d" % self.udp_timeout]
         else:
             socat_cmd = ["socat"]
-        self.proc = subprocess.Popen(socat_cmd + [
+        return socat_cmd + [
             "%s4-LISTEN:%d,reuseaddr,fork,max-children=%d" % (proto, port, self.max_children),
             "%s4:%s:%d" % (proto, toip, toport)
-        ])
+        ]
+
+
+class ForwardMetrics(object):
+    # Thread-safe counters of a forwarder. Keys ending with "_max" keep the
+    # largest value instead of a sum, also when merged across processes.
+    def __init__(self):
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def add(self, key, n=1):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def get(self, key):
+        return self.counters.get(key, 0)
+
+    def add_connect_time(self, sec):
+        ms = sec * 1000
+        with self.lock:
+            self.counters["connect_count"] = self.counters.get("connect_count", 0) + 1
+            self.counters["connect_ms_sum"] = self.counters.get("connect_ms_sum", 0) + ms
+            self.counters["connect_ms_max"] = max(self.counters.get("connect_ms_max", 0), ms)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters)
+
+    @staticmethod
+    def merge(snapshots):
+        total = {}
+        for st in snapshots:
+            for k, v in st.items():
+                if k.endswith("_max"):
+                    total[k] = max(total.get(k, 0), v)
+                else:
+                    total[k] = total.get(k, 0) + v
+        return total
+
+    @staticmethod
+    def summary(st):
+        g = lambda k: st.get(k, 0)
+        if "udp_sessions" in st:
+            text = "sessions %d active/%d total/%d evicted, %d dropped, %d rate limited, %d errors" % (
+                g("udp_sessions"), g("udp_sessions_total"), g("udp_evicted"), g("udp_dropped"),
+                g("rate_dropped"), g("udp_errors")
+            )
+        else:
+            text = "conns %d active/%d total/%d queued/%d rejected, connect %.1f/%.1f ms avg/max, %d failed" % (
+                g("conns_active"), g("conns_total"), g("queued"), g("conns_rejected"),
+                g("connect_ms_sum") / max(g("connect_count"), 1), g("connect_ms_max"),
+                g("connect_errors")
+            )
+        text += ", in %d bytes, out %d bytes" % (g("bytes_in"), g("bytes_out"))
+        if "udp_sessions" in st:
+            text += ", %d/%d packets in/out" % (g("packets_in"), g("packets_out"))
+        if "prewarmed" in st:
+            text += ", prewarmed %d, pool hits %d/misses %d" % (
+                g("prewarmed"), g("pool_hits"), g("pool_misses")
+            )
+        if "processes" in st:
+            text += ", processes %d, restarts %d" % (g("processes"), g("restarts"))
+        return "(%s)" % text
+
+
+class TokenBucket(object):
+    min_burst = 16384
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = self.min_burst
+        self.ts = time.monotonic()
+
+    def consume(self, n, now, strict=False):
+        # Take n tokens and return the seconds to wait until the bucket is
+        # out of debt. With strict=True nothing is taken if n is not available;
+        # n larger than the burst only needs a full bucket, and leaves a debt.
+        # The rate may change between calls, so the burst follows it.
+        burst = max(self.rate / 4, self.min_burst)
+        self.tokens = min(burst, self.tokens + max(now - self.ts, 0) * self.rate)
+        self.ts = now
+        if strict:
+            if self.tokens < min(n, burst):
+                return (min(n, burst) - self.tokens) / self.rate
+            self.tokens -= n
+            return 0
+        self.tokens -= n
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class RateLimiter(object):
+    # Fair-share bandwidth limiter: every active client IP has its own token
+    # bucket; the global rate is split evenly over the active clients and
+    # each share is capped by the per-IP rate. Clients idle longer than
+    # idle_timeout no longer count as active.
+    def __init__(self, rate=0, rate_per_ip=0, idle_timeout=1):
+        if not rate and not rate_per_ip:
+            raise ValueError("No rate limit is given")
+        self.rate = rate
+        self.rate_per_ip = rate_per_ip
+        self.idle_timeout = idle_timeout
+        self.buckets = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def delay(self, ip, n, strict=False):
+        # Charge n bytes to ip, return the seconds the caller should wait
+        now = time.monotonic()
+        with self.lock:
+            while self.buckets:
+                oldest = next(iter(self.buckets.values()))
+                if now - oldest.ts < self.idle_timeout:
+                    break
+                self.buckets.popitem(last=False)
+            bucket = self.buckets.pop(ip, None)
+            if bucket is None:
+                bucket = TokenBucket(self.rate_per_ip or self.rate)
+            self.buckets[ip] = bucket
+            share = self.rate // len(self.buckets) if self.rate else 0
+            bucket.rate = max(min(share or self.rate_per_ip, self.rate_per_ip or share), 1)
+            return bucket.consume(n, now, strict)
+
+    def throttle(self, ip, n):
+        wait = self.delay(ip, n)
+        if wait > 0:
+            time.sleep(wait)
+
+    def allow(self, ip, n):
+        return self.delay(ip, n, strict=True) == 0
+
+
+class WorkerPool(object):
+    # Bounded pool of reusable daemon threads fed by an admission queue.
+    # Tasks beyond max_workers wait in the queue; a full queue rejects.
+    def __init__(self, max_workers, max_queue=0, idle_timeout=60):
+        self.tasks = queue.Queue(max_queue)
+        self.max_workers = max_workers
+        self.idle_timeout = idle_timeout
+        self.workers = 0
+        self.idle = 0
+        self.pending = 0        # submitted but not yet picked up by a worker
+        self.active = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def submit(self, func, args=()):
         try:
-            time.sleep(1)
-            if self.proc.poll() is not None:
-                raise OSError("socat exited too quickly")
-        except Exception:
-            self.proc.kill()
-            self.proc.wait()
-            self.proc = None
-            raise
+            self.tasks.put_nowait((func, args))
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            return False
+        with self.lock:
+            self.pending += 1
+            if self.idle < self.pending and self.workers < self.max_workers:
+                self.workers += 1
+                self.idle += 1
+                start_daemon_thread(self._worker)
+        return True
 
-    def stop_forward(self):
-        Logger.debug("fwd-socat: Stopping socat")
-        if self.proc and self.proc.poll() is not None:
-            return
-        self.proc.terminate()
-        self.proc.wait()
-        self.proc = None
+    def _worker(self):
+        while True:
+            try:
+                func, args = self.tasks.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                with self.lock:
+                    if self.pending:
+                        continue
+                    self.workers -= 1
+                    self.idle -= 1
+                return
+            with self.lock:
+                self.pending -= 1
+                self.idle -= 1
+                self.active += 1
+            try:
+                func(*args)
+            except Exception as ex:
+                Logger.error("worker-pool: task raised an exception: %s" % ex)
+            finally:
+                with self.lock:
+                    self.active -= 1
+                    self.idle += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "workers":  self.workers,
+                "active":   self.active,
+                "queued":   self.tasks.qsize(),
+                "rejected": self.rejected
+            }
+
+
+class OutboundPool(object):
+    # Keeps up to `size` idle TCP connections to the forward target open, so
+    # a new client is handed an established connection without a connect()
+    def __init__(self, addr, size, max_idle=30, rcvbuf=None, sndbuf=None):
+        self.addr = addr
+        self.size = size
+        self.max_idle = max_idle
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
+        self.idle = collections.deque()     # (socket, connected time)
+        self.hits = 0
+        self.misses = 0
+        self.running = False
+        self.cond = threading.Condition()
+
+    def start(self):
+        self.running = True
+        start_daemon_thread(self._refill)
+
+    def get(self):
+        with self.cond:
+            while self.idle:
+                sock, ts = self.idle.popleft()
+                self.cond.notify()
+                if time.time() - ts < self.max_idle and self._is_alive(sock):
+                    self.hits += 1
+                    return sock
+                sock.close()
+            self.misses += 1
+            return None
+
+    def _is_alive(self, sock):
+        # the target may have dropped the idle connection in the meantime
+        try:
+            sock.setblocking(False)
+            return sock.recv(1, socket.MSG_PEEK) != b""
+        except BlockingIOError:
+            return True
+        except (OSError, socket.error):
+            return False
+        finally:
+            sock.settimeout(None)
+
+    def _refill(self):
+        while True:
+            with self.cond:
+                now = time.time()
+                while self.idle and now - self.idle[0][1] >= self.max_idle:
+                    self.idle.popleft()[0].close()
+                while self.running and len(self.idle) >= self.size:
+                    self.cond.wait(1)
+                    if self.idle and time.time() - self.idle[0][1] >= self.max_idle:
+                        break
+                if not self.running:
+                    return
+                if len(self.idle) >= self.size:
+                    continue
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                socket_set_opt(
+                    sock,
+                    timeout     = 3,
+                    rcvbuf      = self.rcvbuf,
+                    sndbuf      = self.sndbuf
+                )
+                sock.connect(self.addr)
+                sock.settimeout(None)
+            except (OSError, socket.error) as ex:
+                Logger.debug("fwd-socket: cannot pre-connect to %s: %s" % (addr_to_str(self.addr), ex))
+                sock.close()
+                time.sleep(1)
+                continue
+            with self.cond:
+                if not self.running:
+                    sock.close()
+                    return
+                self.idle.append((sock, time.time()))
+
+    def stats(self):
+        return {
+            "prewarmed":    len(self.idle),
+            "pool_hits":    self.hits,
+            "pool_misses":  self.misses
+        }
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            while self.idle:
+                self.idle.popleft()[0].close()
+            self.cond.notify_all()
 
 
 class ForwardSocket(object):
+    class UdpSession(object):
+        def __init__(self, sock, addr):
+            self.sock = sock
+            self.addr = addr
+            self.ts = self.last = time.time()
+            self.pkts_in = 0
+            self.pkts_out = 0
+            self.bytes_in = 0
+            self.bytes_out = 0
+
     def __init__(self):
         self.sock = None
         self.sock_type = None
         self.outbound_addr = None
         self.buff_size = 8192
+        self.buff_size_min = 2048
+        self.buff_size_max = 262144
+        self.udp_buff_size = 65535
         self.udp_timeout = 60
-        self.max_threads = 128
+        self.udp_burst = 64
+        self.udp_sessions = {}
+        self.max_sessions = 4096
+        self.backlog = 128
+        self.max_conns = 128
+        self.rcvbuf = None
+        self.sndbuf = None
+        self.reuse_port = False
+        self.prewarm = 0
+        self.pool = None
+        self.relay_pool = None
+        self.outbound_pool = None
+        self.metrics = ForwardMetrics()
+        self.rate_limit = 0         # bytes/s for all clients, 0 = unlimited
+        self.rate_limit_ip = 0      # bytes/s for each client IP
+        self.limiters = None        # RateLimiter for each direction
 
     def __del__(self):
         self.stop_forward()
@@ -938,21 +2194,39 @@ class ForwardSocket(object):
         if (ip, port) == (toip, toport):
             raise ValueError("Cannot forward to the same address %s" %
                              addr_to_str((ip, port)))
+        self.metrics = ForwardMetrics()
+        if self.rate_limit or self.rate_limit_ip:
+            self.limiters = {
+                "bytes_in":  RateLimiter(self.rate_limit, self.rate_limit_ip),
+                "bytes_out": RateLimiter(self.rate_limit, self.rate_limit_ip)
+            }
         self.sock_type = socket.SOCK_DGRAM if udp else socket.SOCK_STREAM
         self.sock = socket.socket(socket.AF_INET, self.sock_type)
+        # connections wait in the pool queue when all workers are busy;
+        # the reverse direction gets its own pool
+        self.pool = WorkerPool(self.max_conns, self.backlog)
+        self.relay_pool = WorkerPool(self.max_conns)
         try:
             socket_set_opt(
                 self.sock,
                 reuse       = True,
-                bind_addr   = ("", port)
+                reuse_port  = self.reuse_port,
+                bind_addr   = ("", port),
+                rcvbuf      = self.rcvbuf,
+                sndbuf      = self.sndbuf
             )
             self.outbound_addr = toip, toport
             Logger.debug("fwd-socket: Starting socket %s forward to %s" % (
                 addr_to_uri((ip, port), udp=udp),
                 addr_to_uri((toip, toport), udp=udp)
             ))
+            if self.prewarm and not udp:
+                self.outbound_pool = OutboundPool(
+                    self.outbound_addr, self.prewarm, rcvbuf=self.rcvbuf, sndbuf=self.sndbuf
+                )
+                self.outbound_pool.start()
             if udp:
-                th = start_daemon_thread(self._socket_udp_recvfrom)
+                th = start_daemon_thread(self._socket_udp_loop)
             else:
                 th = start_daemon_thread(self._socket_tcp_listen)
             time.sleep(1)
@@ -962,98 +2236,693 @@ class ForwardSocket(object):
             self.sock.close()
             self.sock = None
             self.sock_type = None
+            if self.outbound_pool:
+                self.outbound_pool.stop()
+                self.outbound_pool = None
             raise
 
+    def update_forward(self, ip, port, toip, toport, udp=False):
+        # new connections and UDP sessions go to the new target, the
+        # listening socket and established ones are kept
+        if (ip, port) == (toip, toport):
+            raise ValueError("Cannot forward to the same address %s" %
+                             addr_to_str((ip, port)))
+        Logger.debug("fwd-socket: Updating socket %s forward to %s" % (
+            addr_to_uri((ip, port), udp=udp),
+            addr_to_uri((toip, toport), udp=udp)
+        ))
+        self.outbound_addr = toip, toport
+        if self.outbound_pool:
+            # the idle connections go to the old target
+            self.outbound_pool.stop()
+            self.outbound_pool = OutboundPool(
+                self.outbound_addr, self.prewarm, rcvbuf=self.rcvbuf, sndbuf=self.sndbuf
+            )
+            self.outbound_pool.start()
+
     def _socket_tcp_listen(self):
-        self.sock.listen(5)
+        lsock = self.sock
+        lsock.listen(self.backlog)
         while True:
             try:
-                sock_inbound, _ = self.sock.accept()
+                sock_inbound, _ = lsock.accept()
             except (OSError, socket.error) as ex:
                 if not closed_socket_ex(ex):
                     Logger.error("fwd-socket: socket listening thread is exiting: %s" % ex)
                 return
-            sock_outbound = socket.socket(socket.AF_INET, self.sock_type)
+            if not self.pool.submit(self._socket_tcp_relay, args=(sock_inbound,)):
+                self.metrics.add("conns_rejected")
+                Logger.error("fwd-socket: cannot forward port: Admission queue is full %s" %
+                             self.stats_str())
+                sock_inbound.close()
+
+    def _socket_tcp_relay(self, sock_inbound):
+        sock_outbound = self.outbound_pool and self.outbound_pool.get()
+        if not sock_outbound:
+            sock_outbound = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            ts = time.time()
             try:
-                sock_outbound.settimeout(3)
+                socket_set_opt(
+                    sock_outbound,
+                    timeout     = 3,
+                    rcvbuf      = self.rcvbuf,
+                    sndbuf      = self.sndbuf
+                )
                 sock_outbound.connect(self.outbound_addr)
                 sock_outbound.settimeout(None)
-                if threading.active_count() >= self.max_threads:
-                    raise OSError("Too many threads")
-                start_daemon_thread(self._socket_tcp_forward, args=(sock_inbound, sock_outbound))
-                start_daemon_thread(self._socket_tcp_forward, args=(sock_outbound, sock_inbound))
             except (OSError, socket.error) as ex:
+                self.metrics.add("connect_errors")
                 Logger.error("fwd-socket: cannot forward port: %s" % ex)
                 sock_inbound.close()
                 sock_outbound.close()
-                continue
+                return
+            self.metrics.add_connect_time(time.time() - ts)
+        self.metrics.add("conns_total")
+        self.metrics.add("conns_active")
+        try:
+            client_ip = sock_inbound.getpeername()[0]
+            self.relay_pool.submit(self._socket_tcp_forward,
+                                   args=(sock_outbound, sock_inbound, "bytes_out", client_ip))
+            self._socket_tcp_forward(sock_inbound, sock_outbound, "bytes_in", client_ip)
+        except (OSError, socket.error):
+            self._socket_tcp_close(sock_inbound, sock_outbound)
+        finally:
+            self.metrics.add("conns_active", -1)
 
-    def _socket_tcp_forward(self, sock_to_recv, sock_to_send):
+    def _socket_tcp_forward(self, sock_to_recv, sock_to_send, counter="bytes_in", client_ip=None):
+        ts = time.time()
+        total = 0
+        size = self.buff_size
         try:
             while sock_to_recv.fileno() != -1:
-                buff = sock_to_recv.recv(self.buff_size)
+                buff = sock_to_recv.recv(size)
                 if buff and sock_to_send.fileno() != -1:
                     sock_to_send.sendall(buff)
+                    total += len(buff)
+                    self.metrics.add(counter, len(buff))
+                    if self.limiters:
+                        self.limiters[counter].throttle(client_ip, len(buff))
+                    size = self._adapt_buff_size(size, len(buff))
                 else:
-                    sock_to_recv.close()
-                    sock_to_send.close()
                     return
         except (OSError, socket.error) as ex:
             if not closed_socket_ex(ex):
                 Logger.error("fwd-socket: socket forwarding thread is exiting: %s" % ex)
-            sock_to_recv.close()
-            sock_to_send.close()
             return
+        finally:
+            self._socket_tcp_close(sock_to_recv, sock_to_send)
+            self._log_throughput(total, ts, size)
+
+    def _socket_tcp_close(self, *socks):
+        # shutdown() first: close() alone does not wake up the thread
+        # forwarding the other direction, which is still blocked in recv()
+        for sock in socks:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except (OSError, socket.error):
+                pass
+            sock.close()
+
+    def _adapt_buff_size(self, size, n):
+        # grow on full reads, shrink when reads get small
+        if n >= size:
+            return min(size * 2, self.buff_size_max)
+        if n < size // 4:
+            return max(size // 2, self.buff_size_min)
+        return size
+
+    def _log_throughput(self, total, ts, size):
+        elapsed = max(time.time() - ts, 0.001)
+        Logger.debug("fwd-socket: Relayed %d bytes in %.3f s (%.1f KiB/s), buffer %d" % (
+            total, elapsed, total / elapsed / 1024, size
+        ))
+
+    def _socket_udp_loop(self):
+        # one loop for the listening socket and every session's outbound
+        # socket; sessions are kept in LRU order for cheap idle eviction
+        server_sock = self.sock
+        sel = selectors.DefaultSelector()
+        sessions = self.udp_sessions = collections.OrderedDict()
+        batch = UdpBatch(self.udp_buff_size)
+        try:
+            server_sock.setblocking(False)
+            batch.enable_gro(server_sock)
+            sel.register(server_sock, selectors.EVENT_READ, None)
+            while server_sock.fileno() != -1:
+                for key, _ in sel.select(timeout=1):
+                    if key.data is None:
+                        self._udp_from_client(sel, server_sock, sessions, batch)
+                    else:
+                        self._udp_from_target(sel, server_sock, sessions, key.data, batch)
+                now = time.time()
+                while sessions:
+                    sess = next(iter(sessions.values()))
+                    if now - sess.last < self.udp_timeout:
+                        break
+                    self._udp_session_close(sel, sessions, sess, "idle")
+        except (OSError, socket.error) as ex:
+            if server_sock.fileno() != -1 and not closed_socket_ex(ex):
+                Logger.error("fwd-socket: socket recvfrom thread is exiting: %s" % ex)
+        finally:
+            for sess in list(sessions.values()):
+                sess.sock.close()
+            sessions.clear()
+            sel.close()
+
+    def _udp_from_client(self, sel, server_sock, sessions, batch):
+        for _ in range(self.udp_burst):
+            try:
+                data, addr, seg = batch.recv(server_sock)
+            except BlockingIOError:
+                return
+            except (OSError, socket.error) as ex:
+                # a closed socket ends the loop; other errors, like ICMP errors
+                # reported on the socket, concern a single client
+                if server_sock.fileno() == -1 or closed_socket_ex(ex):
+                    raise
+                Logger.debug("fwd-socket: cannot receive datagram: %s" % ex)
+                self.metrics.add("udp_errors")
+                continue
+            if self.limiters:
+                data, seg = self._udp_admit("bytes_in", addr[0], data, seg)
+                if data is None:
+                    continue
+            sess = sessions.get(addr)
+            try:
+                if sess is None:
+                    sess = self._udp_session_open(sel, sessions, addr, batch)
+                else:
+                    sessions.move_to_end(addr)
+                pkts = batch.send(sess.sock, data, seg)
+            except BlockingIOError:
+                self.metrics.add("udp_dropped")
+                continue
+            except (OSError, socket.error) as ex:
+                Logger.debug("fwd-socket: cannot forward datagram from %s: %s" % (
+                    addr_to_str(addr), ex
+                ))
+                if sess is not None:
+                    self._udp_session_close(sel, sessions, sess, "error")
+                continue
+            sess.last = time.time()
+            sess.pkts_in += pkts
+            sess.bytes_in += len(data)
+            self.metrics.add("packets_in", pkts)
+            self.metrics.add("bytes_in", len(data))
+
+    def _udp_from_target(self, sel, server_sock, sessions, sess, batch):
+        for _ in range(self.udp_burst):
+            try:
+                data, _, seg = batch.recv(sess.sock)
+            except BlockingIOError:
+                return
+            except (OSError, socket.error) as ex:
+                Logger.debug("fwd-socket: cannot receive datagram for %s: %s" % (
+                    addr_to_str(sess.addr), ex
+                ))
+                self._udp_session_close(sel, sessions, sess, "error")
+                return
+            if self.limiters:
+                data, seg = self._udp_admit("bytes_out", sess.addr[0], data, seg)
+                if data is None:
+                    continue
+            try:
+                pkts = batch.send(server_sock, data, seg, sess.addr)
+            except BlockingIOError:
+                self.metrics.add("udp_dropped")
+                continue
+            except (OSError, socket.error) as ex:
+                Logger.debug("fwd-socket: cannot forward datagram to %s: %s" % (
+                    addr_to_str(sess.addr), ex
+                ))
+                self._udp_session_close(sel, sessions, sess, "error")
+                return
+            sess.last = time.time()
+            sess.pkts_out += pkts
+            sess.bytes_out += len(data)
+            self.metrics.add("packets_out", pkts)
+            self.metrics.add("bytes_out", len(data))
+            sessions.move_to_end(sess.addr)
+
+    def _udp_admit(self, counter, ip, data, seg):
+        # Charge the datagrams of data one by one and return the admitted
+        # ones, or None: a GRO batch may be larger than the bucket ever holds.
+        limiter = self.limiters[counter]
+        if not seg:
+            if limiter.allow(ip, len(data)):
+                return data, 0
+            self.metrics.add("rate_dropped")
+            return None, 0
+        size = 0
+        while size < len(data):
+            if not limiter.allow(ip, min(seg, len(data) - size)):
+                self.metrics.add("rate_dropped", -(-(len(data) - size) // seg))
+                break
+            size += seg
+        size = min(size, len(data))
+        if not size:
+            return None, 0
+        return data[:size], (seg if size > seg else 0)
+
+    def _udp_session_open(self, sel, sessions, addr, batch):
+        if len(sessions) >= self.max_sessions:
+            self.metrics.add("udp_evicted")
+            self._udp_session_close(sel, sessions, next(iter(sessions.values())), "evicted")
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            socket_set_opt(
+                sock,
+                timeout     = 0,
+                rcvbuf      = self.rcvbuf,
+                sndbuf      = self.sndbuf
+            )
+            batch.enable_gro(sock)
+            sock.connect(self.outbound_addr)
+            sess = ForwardSocket.UdpSession(sock, addr)
+            sel.register(sock, selectors.EVENT_READ, sess)
+        except Exception:
+            sock.close()
+            raise
+        sessions[addr] = sess
+        self.metrics.add("udp_sessions_total")
+        return sess
+
+    def _udp_session_close(self, sel, sessions, sess, reason):
+        del sessions[sess.addr]
+        sel.unregister(sess.sock)
+        sess.sock.close()
+        Logger.debug(
+            "fwd-socket: UDP session %s closed (%s), %d/%d packets, %d/%d bytes in/out, %.1f s" % (
+                addr_to_str(sess.addr), reason, sess.pkts_in, sess.pkts_out,
+                sess.bytes_in, sess.bytes_out, time.time() - sess.ts
+            )
+        )
 
-    def _socket_udp_recvfrom(self):
-        outbound_socks = {}
+    def stats(self):
+        st = self.metrics.snapshot()
+        if self.sock_type == socket.SOCK_DGRAM:
+            st["udp_sessions"] = len(self.udp_sessions)
+        elif self.pool:
+            st["queued"] = self.pool.stats()["queued"]
+        if self.outbound_pool:
+            st.update(self.outbound_pool.stats())
+        return st
+
+    def stats_str(self):
+        return ForwardMetrics.summary(self.stats())
+
+    def stop_forward(self):
+        if self.outbound_pool:
+            self.outbound_pool.stop()
+            self.outbound_pool = None
+        if self.sock and self.sock.fileno() != -1:
+            Logger.debug("fwd-socket: Stopping socket")
+            self.sock.close()
+            self.sock = None
+            self.sock_type = None
+
+
+class ForwardSocketSplice(ForwardSocket):
+    # Relay TCP data with splice(2) through a pipe on Linux, so payload never
+    # enters userspace. Fall back to recv_into() on a reusable buffer elsewhere.
+    def __init__(self):
+        super().__init__()
+        self.buff_size = 65536
+        self.use_splice = hasattr(os, "splice")
+
+    def start_forward(self, ip, port, toip, toport, udp=False):
+        if not udp:
+            Logger.debug("fwd-socket: Using %s relay" % (
+                "splice()" if self.use_splice else "recv_into()"
+            ))
+        super().start_forward(ip, port, toip, toport, udp=udp)
+
+    def _socket_tcp_forward(self, sock_to_recv, sock_to_send, counter="bytes_in", client_ip=None):
+        ts = time.time()
+        try:
+            if self.use_splice:
+                total = self._socket_tcp_splice(sock_to_recv, sock_to_send, counter, client_ip)
+            else:
+                total = self._socket_tcp_recv_into(sock_to_recv, sock_to_send, counter, client_ip)
+            self._log_throughput(total, ts, self.buff_size)
+        except (OSError, socket.error) as ex:
+            if not closed_socket_ex(ex):
+                Logger.error("fwd-socket: socket forwarding thread is exiting: %s" % ex)
+        finally:
+            self._socket_tcp_close(sock_to_recv, sock_to_send)
+
+    def _socket_tcp_splice(self, sock_to_recv, sock_to_send, counter, client_ip):
+        pipe_r, pipe_w = os.pipe()
+        total = 0
+        try:
+            while True:
+                n = os.splice(sock_to_recv.fileno(), pipe_w, self.buff_size)
+                if not n:
+                    return total
+                total += n
+                self.metrics.add(counter, n)
+                if self.limiters:
+                    self.limiters[counter].throttle(client_ip, n)
+                while n:
+                    n -= os.splice(pipe_r, sock_to_send.fileno(), n)
+        finally:
+            os.close(pipe_r)
+            os.close(pipe_w)
+
+    def _socket_tcp_recv_into(self, sock_to_recv, sock_to_send, counter, client_ip):
+        buff = memoryview(bytearray(self.buff_size))
+        total = 0
+        while True:
+            n = sock_to_recv.recv_into(buff)
+            if not n:
+                return total
+            total += n
+            self.metrics.add(counter, n)
+            sock_to_send.sendall(buff[:n])
+            if self.limiters:
+                self.limiters[counter].throttle(client_ip, n)
+
+
+class ForwardSocketLoop(ForwardSocket):
+    # Relay all TCP connections on one event loop thread (epoll/kqueue via
+    # selectors) instead of two threads per connection, like UDP sessions.
+    class Stream(object):
+        def __init__(self, sock, counter, client_ip, connecting=False):
+            self.sock = sock
+            self.counter = counter      # metrics key for bytes received
+            self.client_ip = client_ip
+            self.peer = None
+            self.wbuf = bytearray()     # data waiting to be sent to self.sock
+            self.events = 0
+            self.eof = False            # self.sock has sent FIN
+            self.shut = False           # FIN has been forwarded to self.sock
+            self.closed = False
+            self.connecting = connecting
+            self.ts = time.time()
+            self.rsize = 0              # adaptive recv size
+            self.total = 0              # bytes received from self.sock
+            self.resume = 0             # rate limited: no reading until then
+
+    def __init__(self):
+        super().__init__()
+        self.max_conns = 4096
+        self.max_pending = 262144
+        self.connect_timeout = 3
+
+    def _socket_tcp_listen(self):
+        lsock = self.sock
+        sel = selectors.DefaultSelector()
+        pending = set()
+        paused = set()
+        try:
+            lsock.listen(self.backlog)
+            lsock.setblocking(False)
+            sel.register(lsock, selectors.EVENT_READ, None)
+            while lsock.fileno() != -1:
+                timeout = 1
+                if paused:
+                    timeout = min(min(st.resume for st in paused) - time.monotonic(), 1)
+                for key, mask in sel.select(timeout=max(timeout, 0)):
+                    if key.data is None:
+                        self._loop_accept(sel, lsock, pending)
+                    else:
+                        self._loop_io(sel, key.data, mask, pending, paused)
+                self._loop_resume(sel, paused)
+                now = time.time()
+                for st in list(pending):
+                    if now - st.ts > self.connect_timeout:
+                        self.metrics.add("connect_errors")
+                        Logger.error("fwd-socket: cannot forward port: connect timed out")
+                        self._loop_close(sel, st, pending)
+        except (OSError, socket.error) as ex:
+            if lsock.fileno() != -1 and not closed_socket_ex(ex):
+                Logger.error("fwd-socket: socket event loop is exiting: %s" % ex)
+        finally:
+            for key in list(sel.get_map().values()):
+                if key.data is not None:
+                    key.data.sock.close()
+            sel.close()
+
+    def _loop_accept(self, sel, lsock, pending):
         while True:
             try:
-                buff, addr = self.sock.recvfrom(self.buff_size)
-                s = outbound_socks.get(addr)
+                sock_inbound, client_addr = lsock.accept()
+            except BlockingIOError:
+                return
             except (OSError, socket.error) as ex:
                 if not closed_socket_ex(ex):
-                    Logger.error("fwd-socket: socket recvfrom thread is exiting: %s" % ex)
+                    Logger.error("fwd-socket: cannot accept connection: %s" % ex)
                 return
+            if self.metrics.get("conns_active") >= self.max_conns:
+                self.metrics.add("conns_rejected")
+                Logger.error("fwd-socket: cannot forward port: Too many connections %s" %
+                             self.stats_str())
+                sock_inbound.close()
+                continue
+            sock_outbound = self.outbound_pool and self.outbound_pool.get()
+            if sock_outbound:
+                sock_inbound.setblocking(False)
+                sock_outbound.setblocking(False)
+                self._loop_add(sel, sock_inbound, sock_outbound, client_addr[0], pending, False)
+                continue
+            sock_outbound = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             try:
-                if not s:
-                    s = outbound_socks[addr] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                    s.settimeout(self.udp_timeout)
-                    s.connect(self.outbound_addr)
-                    if threading.active_count() >= self.max_threads:
-                        raise OSError("Too many threads")
-                    start_daemon_thread(self._socket_udp_send, args=(self.sock, s, addr))
-                if buff:
-                    s.send(buff)
-                else:
-                    s.close()
-                    del outbound_socks[addr]
-            except (OSError, socket.error):
-                if addr in outbound_socks:
-                    outbound_socks[addr].close()
-                    del outbound_socks[addr]
+                sock_inbound.setblocking(False)
+                socket_set_opt(
+                    sock_outbound,
+                    timeout     = 0,
+                    rcvbuf      = self.rcvbuf,
+                    sndbuf      = self.sndbuf
+                )
+                err = sock_outbound.connect_ex(self.outbound_addr)
+                if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK,
+                               getattr(errno, "WSAEWOULDBLOCK", errno.EWOULDBLOCK)):
+                    raise OSError(err, os.strerror(err))
+            except (OSError, socket.error) as ex:
+                self.metrics.add("connect_errors")
+                Logger.error("fwd-socket: cannot forward port: %s" % ex)
+                sock_inbound.close()
+                sock_outbound.close()
                 continue
-
-    def _socket_udp_send(self, server_sock, outbound_sock, client_addr):
+            self._loop_add(sel, sock_inbound, sock_outbound, client_addr[0], pending, True)
+
+    def _loop_add(self, sel, sock_inbound, sock_outbound, client_ip, pending, connecting):
+        st_in = ForwardSocketLoop.Stream(sock_inbound, "bytes_in", client_ip)
+        st_out = ForwardSocketLoop.Stream(sock_outbound, "bytes_out", client_ip, connecting=connecting)
+        st_in.peer, st_out.peer = st_out, st_in
+        st_in.rsize = st_out.rsize = self.buff_size
+        if connecting:
+            pending.add(st_out)
+        self.metrics.add("conns_total")
+        self.metrics.add("conns_active")
+        self._loop_update(sel, st_in)
+        self._loop_update(sel, st_out)
+
+    def _loop_io(self, sel, st, mask, pending, paused):
         try:
-            while outbound_sock.fileno() != -1:
-                buff = outbound_sock.recv(self.buff_size)
+            if st.connecting:
+                err = st.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    self.metrics.add("connect_errors")
+                    raise OSError(err, os.strerror(err))
+                st.connecting = False
+                pending.discard(st)
+                self.metrics.add_connect_time(time.time() - st.ts)
+            elif mask & selectors.EVENT_READ:
+                try:
+                    buff = st.sock.recv(st.rsize)
+                except BlockingIOError:
+                    buff = None
                 if buff:
-                    server_sock.sendto(buff, client_addr)
-                else:
-                    outbound_sock.close()
+                    st.peer.wbuf += buff
+                    st.total += len(buff)
+                    self.metrics.add(st.counter, len(buff))
+                    st.rsize = self._adapt_buff_size(st.rsize, len(buff))
+                    wait = self.limiters and self.limiters[st.counter].delay(st.client_ip, len(buff))
+                    if wait:
+                        st.resume = time.monotonic() + wait
+                        paused.add(st)
+                elif buff is not None:
+                    st.eof = True
+            for s in (st, st.peer):
+                if not s.connecting:
+                    self._loop_send(s)
         except (OSError, socket.error) as ex:
             if not closed_socket_ex(ex):
-                Logger.error("fwd-socket: socket send thread is exiting: %s" % ex)
-            outbound_sock.close()
+                Logger.error("fwd-socket: connection is closing: %s" % ex)
+            self._loop_close(sel, st, pending)
+            return
+        if st.shut and st.peer.shut:
+            self._loop_close(sel, st, pending)
+            return
+        self._loop_update(sel, st)
+        self._loop_update(sel, st.peer)
+
+    def _loop_send(self, st):
+        if st.wbuf:
+            try:
+                n = st.sock.send(st.wbuf)
+                del st.wbuf[:n]
+            except BlockingIOError:
+                pass
+        if not st.wbuf and st.peer.eof and not st.shut:
+            st.sock.shutdown(socket.SHUT_WR)
+            st.shut = True
+
+    def _loop_update(self, sel, st):
+        # backpressure: stop reading while the peer still has too much to send
+        events = 0
+        if st.connecting:
+            events = selectors.EVENT_WRITE
+        else:
+            if not st.eof and not st.resume and len(st.peer.wbuf) < self.max_pending:
+                events |= selectors.EVENT_READ
+            if st.wbuf:
+                events |= selectors.EVENT_WRITE
+        if events == st.events:
+            return
+        if not st.events:
+            sel.register(st.sock, events, st)
+        elif not events:
+            sel.unregister(st.sock)
+        else:
+            sel.modify(st.sock, events, st)
+        st.events = events
+
+    def _loop_resume(self, sel, paused):
+        now = time.monotonic()
+        for st in list(paused):
+            if st.closed:
+                paused.discard(st)
+            elif now >= st.resume:
+                st.resume = 0
+                paused.discard(st)
+                self._loop_update(sel, st)
+
+    def _loop_close(self, sel, st, pending):
+        if st.closed:
             return
+        for s in (st, st.peer):
+            if s.events:
+                sel.unregister(s.sock)
+                s.events = 0
+            s.sock.close()
+            s.closed = True
+            pending.discard(s)
+            self._log_throughput(s.total, s.ts, s.rsize)
+        self.metrics.add("conns_active", -1)
+
+
+class ForwardSocketWorkers(object):
+    # Run a socket forwarder in several processes, each binding the port with
+    # SO_REUSEPORT, so the kernel spreads TCP connections and UDP flows over
+    # them. Dead workers are restarted; their stats are summed here.
+    # current values, not totals: they die with the worker
+    gauges = ("conns_active", "queued", "udp_sessions", "prewarmed")
+
+    def __init__(self, forwarder_cls, config, processes):
+        # each worker builds its own forwarder from the class and its settings,
+        # since a forwarder cannot be pickled for the spawn start method
+        self.forwarder_cls = forwarder_cls
+        self.config = dict(config, reuse_port=True)
+        self.processes = processes
+        self.procs = []
+        self.conns = []
+        self.reports = []
+        self.retired = {}           # totals of the workers restarted so far
+        self.args = None
+        self.restarts = 0
+        self.running = False
+        self.lock = threading.Lock()
+        self.interval = 1
+
+    def __del__(self):
+        self.stop_forward()
+
+    def start_forward(self, ip, port, toip, toport, udp=False):
+        if (ip, port) == (toip, toport):
+            raise ValueError("Cannot forward to the same address %s" %
+                             addr_to_str((ip, port)))
+        Logger.debug("fwd-workers: Starting %d socket forwarding processes" % self.processes)
+        self.args = (ip, port, toip, toport, udp)
+        self.procs = [None] * self.processes
+        self.conns = [None] * self.processes
+        self.reports = [{}] * self.processes
+        self.retired = {}
+        with self.lock:
+            self.running = True
+            for i in range(self.processes):
+                self._spawn(i)
+        time.sleep(1.5)
+        if not all(p.is_alive() for p in self.procs):
+            self.stop_forward()
+            raise OSError("Socket forwarding process exited too quickly")
+        start_daemon_thread(self._supervise)
+
+    def _spawn(self, i):
+        conn_parent, conn_child = multiprocessing.Pipe(duplex=False)
+        # a forked worker inherits the parent ends of all pipes; it must close
+        # them, or its own pipe never breaks
+        inherited = []
+        if multiprocessing.get_start_method() == "fork":
+            inherited = [conn for conn in self.conns if conn] + [conn_parent]
+        proc = multiprocessing.Process(
+            target=forward_worker_main,
+            args=(self.forwarder_cls, self.config, self.args, conn_child, os.getpid(), inherited)
+        )
+        proc.daemon = True
+        proc.start()
+        conn_child.close()
+        self.procs[i] = proc
+        self.conns[i] = conn_parent
+        if self.reports[i]:
+            # keep the counters of the dead worker, so the totals never drop
+            report = dict((k, v) for k, v in self.reports[i].items() if k not in self.gauges)
+            self.retired = ForwardMetrics.merge([self.retired, report])
+        self.reports[i] = {}
+
+    def _supervise(self):
+        while True:
+            with self.lock:
+                if not self.running:
+                    return
+                for i, proc in enumerate(self.procs):
+                    try:
+                        while self.conns[i].poll():
+                            self.reports[i] = self.conns[i].recv()
+                    except (OSError, EOFError):
+                        pass
+                    if not proc.is_alive():
+                        self.restarts += 1
+                        Logger.error("fwd-workers: process %d exited with code %s, restarting" % (
+                            proc.pid, proc.exitcode
+                        ))
+                        self.conns[i].close()
+                        self._spawn(i)
+            time.sleep(self.interval)
+
+    def stats(self):
+        total = ForwardMetrics.merge([self.retired] + self.reports)
+        total["processes"] = sum(1 for p in self.procs if p and p.is_alive())
+        total["restarts"] = self.restarts
+        return total
+
+    def stats_str(self):
+        return ForwardMetrics.summary(self.stats())
 
     def stop_forward(self):
-        if self.sock and self.sock.fileno() != -1:
-            Logger.debug("fwd-socket: Stopping socket")
-            self.sock.close()
-            self.sock = None
-            self.sock_type = None
+        with self.lock:
+            if not self.running:
+                return
+            Logger.debug("fwd-workers: Stopping socket forwarding processes")
+            self.running = False
+            for proc in self.procs:
+                if proc:
+                    proc.terminate()
+            for i, proc in enumerate(self.procs):
+                if proc:
+                    proc.join()
+                    self.conns[i].close()
 
 
 class UPnPService(object):
@@ -1259,13 +3128,7 @@ class UPnPClient(object):
         self.ssdp_addr          = ("239.255.255.250", 1900)
         self.router             = None
         self._sock_timeout      = 1
-        self._fwd_host          = None
-        self._fwd_port          = None
-        self._fwd_dest_host     = None
-        self._fwd_dest_port     = None
-        self._fwd_udp           = False
-        self._fwd_duration      = 0
-        self._fwd_started       = False
+        self._fwd_list          = []
         self._bind_ip           = bind_ip
         self._bind_interface    = interface
 
@@ -1350,24 +3213,247 @@ class UPnPClient(object):
         if not self.router:
             raise RuntimeError("No router is available")
         self.router.forward_srv.forward_port(host, port, dest_host, dest_port, udp, duration)
-        self._fwd_host      = host
-        self._fwd_port      = port
-        self._fwd_dest_host = dest_host
-        self._fwd_dest_port = dest_port
-        self._fwd_udp       = udp
-        self._fwd_duration  = duration
-        self._fwd_started   = True
+        self._fwd_list.append((host, port, dest_host, dest_port, udp, duration))
 
     def renew(self):
-        if not self._fwd_started:
+        if not self._fwd_list:
             raise RuntimeError("UPnP forward not started")
-        self.router.forward_srv.forward_port(
-            self._fwd_host, self._fwd_port, self._fwd_dest_host,
-            self._fwd_dest_port, self._fwd_udp, self._fwd_duration
-        )
+        for fwd in self._fwd_list:
+            self.router.forward_srv.forward_port(*fwd)
         Logger.debug("upnp: OK")
 
 
+class NatterMapping(object):
+    # One port opened by Natter: a local port, its NAT mapping kept open by
+    # keep-alive, and the forwarding from it to the target. The mappings of
+    # one process share the forwarder where the method allows it, the STUN
+    # scoreboard, the DNS cache and the scheduler.
+    def __init__(self, udp, bind_port, to_ip, to_port):
+        self.udp = udp
+        self.bind_port = bind_port
+        self.to_ip = to_ip
+        self.to_port = to_port
+        self.forwarder = None
+        self.stun = None
+        self.keep_alive = None
+        self.nat_info = None
+        self.natter_addr = None
+        self.outer_addr = None
+        self.to_addr = None
+        self.broken_since = None        # monotonic start of the first failed keep-alive
+        self.remaps = 0
+        self.last_outage = None         # seconds
+
+    def __repr__(self):
+        if self.natter_addr:
+            return "%s-%d" % (self.protocol, self.natter_addr[1])
+        return "%s-%d" % (self.protocol, self.bind_port)
+
+    @property
+    def protocol(self):
+        return "udp" if self.udp else "tcp"
+
+    def open(self, forwarder, stun, keepalive_srv_list, keepalive_parallel=1, analyze=0,
+             keepalive_timeout=3):
+        self.forwarder = forwarder
+        self.stun = stun
+        natter_addr, outer_addr = stun.get_mapping()
+        # set actual ip and port for keep-alive socket to bind, instead of zero
+        self.keep_alive = KeepAliveGroup(keepalive_srv_list, natter_addr[0], natter_addr[1],
+                                         udp=self.udp, interface=stun.interface,
+                                         parallel=keepalive_parallel, timeout=keepalive_timeout)
+        self.keep_alive.keep_alive()
+
+        # get the mapped address again after the keep-alive connection is established
+        outer_addr_prev = outer_addr
+        if analyze:
+            # ask several servers at once, instead of a second serial probe
+            self.nat_info = stun.analyze(analyze)
+            natter_addr, outer_addr = self.nat_info["inner"], self.nat_info["outer"]
+            Logger.info("NAT type: %s" % self.nat_info["type"])
+            consistent = self.nat_info["consistent"]
+        else:
+            natter_addr, outer_addr = stun.get_mapping()
+            consistent = True
+        if outer_addr != outer_addr_prev or not consistent:
+            Logger.warning("Network is unstable, or not full cone")
+        self.natter_addr, self.outer_addr = natter_addr, outer_addr
+
+        to_ip, to_port = self.to_ip, self.to_port
+        # set actual ip of localhost for correct forwarding
+        if socket.inet_aton(to_ip) in [socket.inet_aton("127.0.0.1"), socket.inet_aton("0.0.0.0")]:
+            to_ip = natter_addr[0]
+        # if not specified, the target port is set to be the same as the outer port
+        if not to_port:
+            to_port = outer_addr[1]
+        # some exceptions: ForwardNone and ForwardTestServer are not real forward methods,
+        # so let target ip and port equal to natter's
+        if isinstance(forwarder, (ForwardNone, ForwardTestServer)):
+            to_ip, to_port = natter_addr
+        self.to_addr = (to_ip, to_port)
+        forwarder.start_forward(natter_addr[0], natter_addr[1], to_ip, to_port, udp=self.udp)
+
+    def remap(self, outer_addr):
+        # The NAT mapped the same local port to a new outer address. Only
+        # what depends on the outer address is updated: the forwarder keeps
+        # its sockets, rules and established connections.
+        self.outer_addr = outer_addr
+        self.remaps += 1
+        if self.to_port or isinstance(self.forwarder, (ForwardNone, ForwardTestServer)):
+            return
+        # the target port follows the outer port
+        to_addr = (self.to_addr[0], outer_addr[1])
+        if to_addr == self.to_addr:
+            return
+        ip, port = self.natter_addr
+        if hasattr(self.forwarder, "update_forward"):
+            self.forwarder.update_forward(ip, port, to_addr[0], to_addr[1], udp=self.udp)
+        else:
+            # not shared with other mappings, see natter_main
+            self.forwarder.stop_forward()
+            self.forwarder.start_forward(ip, port, to_addr[0], to_addr[1], udp=self.udp)
+        self.to_addr = to_addr
+
+    def route_str(self, method):
+        route_str = ""
+        if not isinstance(self.forwarder, (ForwardNone, ForwardTestServer)):
+            route_str += "%s <--%s--> " % (addr_to_uri(self.to_addr, udp=self.udp), method)
+        route_str += "%s <--Natter--> %s" % (
+            addr_to_uri(self.natter_addr, udp=self.udp), addr_to_uri(self.outer_addr, udp=self.udp)
+        )
+        return route_str
+
+    def stats(self):
+        st = {
+            "protocol":     self.protocol,
+            "inner_addr":   addr_to_str(self.natter_addr),
+            "outer_addr":   addr_to_str(self.outer_addr),
+            "target_addr":  addr_to_str(self.to_addr),
+            "remaps":       self.remaps,
+            "last_outage_ms": None if self.last_outage is None else round(self.last_outage * 1000, 1)
+        }
+        if hasattr(self.forwarder, "stats"):
+            st["forward"] = self.forwarder.stats()
+        return st
+
+
+class NatterSupervisor(object):
+    # Run the periodic jobs of natter_main as independent asyncio tasks on
+    # their own timers. The blocking work runs in executor threads, so a
+    # hung STUN server or UPnP router never delays a keep-alive. The first
+    # exception raised by a job stops all jobs, and run() raises it once the
+    # threads of all jobs have finished; an exit or retry request wins.
+    # Jobs run on a fixed grid of deadlines of the loop's monotonic clock, so
+    # wall-clock steps and slow runs neither shift nor bunch them.
+    class Job(object):
+        def __init__(self, name, func, interval, delay):
+            self.name = name
+            self.func = func
+            self.interval = interval
+            self.delay = delay
+            self.wake = None
+            self.runs = 0
+            self.missed = 0         # deadlines skipped because a run was late
+            self.late_sum = 0       # seconds between deadline and start
+            self.late_max = 0
+
+        def stats(self):
+            return {
+                "runs":         self.runs,
+                "missed":       self.missed,
+                "late_avg_ms":  round(self.late_sum / max(self.runs, 1) * 1000, 1),
+                "late_max_ms":  round(self.late_max * 1000, 1)
+            }
+
+    def __init__(self):
+        self.jobs = collections.OrderedDict()
+        self.loop = None
+
+    def add_job(self, name, func, interval, delay=0):
+        self.jobs[name] = NatterSupervisor.Job(name, func, interval, delay)
+
+    def stats(self):
+        return {name: job.stats() for name, job in self.jobs.items()}
+
+    def set_interval(self, name, interval):
+        # takes effect from the job's next deadline
+        self.jobs[name].interval = interval
+
+    def wake(self, name):
+        # thread-safe: run the job now instead of waiting for its timer
+        job = self.jobs[name]
+        if self.loop and job.wake:
+            self.loop.call_soon_threadsafe(job.wake.set)
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        # a thread for every job, however many mappings there are
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.jobs))
+        self.loop.set_default_executor(executor)
+        main_task = self.loop.create_task(self._main())
+        try:
+            self.loop.run_until_complete(main_task)
+        finally:
+            # interrupted by a signal: let the tasks clean up before closing
+            if not main_task.done():
+                main_task.cancel()
+                try:
+                    self.loop.run_until_complete(main_task)
+                except asyncio.CancelledError:
+                    pass
+            # cancelled jobs go on in their threads: wait for them, so nothing
+            # touches the sockets or the port after run() returns
+            executor.shutdown(wait=True)
+            self.loop.close()
+            self.loop = None
+            asyncio.set_event_loop(None)
+
+    async def _main(self):
+        for job in self.jobs.values():
+            job.wake = asyncio.Event()
+        tasks = [self.loop.create_task(self._run_job(job)) for job in self.jobs.values()]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for task in tasks:
+                task.cancel()
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        errors = [
+            ex for ex in results
+            if isinstance(ex, Exception) and not isinstance(ex, asyncio.CancelledError)
+        ]
+        # an exit or retry request goes before the errors of other jobs
+        errors.sort(key=lambda ex: not isinstance(ex, (NatterExitException, NatterRetryException)))
+        if errors:
+            raise errors[0]
+
+    async def _run_job(self, job):
+        deadline = self.loop.time() + job.delay
+        while True:
+            try:
+                await asyncio.wait_for(job.wake.wait(), max(deadline - self.loop.time(), 0))
+                # woken up early: the grid restarts from now
+                deadline = self.loop.time()
+            except asyncio.TimeoutError:
+                pass
+            job.wake.clear()
+            late = max(self.loop.time() - deadline, 0)
+            job.runs += 1
+            job.late_sum += late
+            job.late_max = max(job.late_max, late)
+            await self.loop.run_in_executor(None, job.func)
+            deadline += job.interval
+            now = self.loop.time()
+            if now > deadline:
+                missed = int((now - deadline) // job.interval) + 1
+                job.missed += missed
+                Logger.warning("%s: missed %d deadline(s), %.1f seconds late, %d missed in total" % (
+                    job.name, missed, now - deadline, job.missed
+                ))
+                deadline += missed * job.interval
+
+
 class NatterExitException(Exception):
     pass
 
@@ -1376,12 +3462,21 @@ class NatterRetryException(Exception):
     pass
 
 
-def socket_set_opt(sock, reuse=False, bind_addr=None, interface=None, timeout=-1):
+def socket_set_opt(sock, reuse=False, bind_addr=None, interface=None, timeout=-1,
+                   rcvbuf=None, sndbuf=None, reuse_port=False):
     if reuse:
         if hasattr(socket, "SO_REUSEADDR"):
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         if hasattr(socket, "SO_REUSEPORT"):
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if reuse_port:
+        # required, and load-balanced between all sockets bound to the port
+        if hasattr(socket, "SO_REUSEPORT_LB"):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT_LB, 1)
+        elif hasattr(socket, "SO_REUSEPORT"):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        else:
+            raise RuntimeError("SO_REUSEPORT is not supported on your platform.")
     if interface is not None:
         if hasattr(socket, "SO_BINDTODEVICE"):
             sock.setsockopt(
@@ -1389,6 +3484,10 @@ def socket_set_opt(sock, reuse=False, bind_addr=None, interface=None, timeout=-1
             )
         else:
             raise RuntimeError("Binding to an interface is not supported on your platform.")
+    if rcvbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    if sndbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
     if bind_addr is not None:
         sock.bind(bind_addr)
     if timeout != -1:
@@ -1396,6 +3495,14 @@ def socket_set_opt(sock, reuse=False, bind_addr=None, interface=None, timeout=-1
     return sock
 
 
+def write_json_file(path, data):
+    # write to a temporary file first, readers never see a partial file
+    tmp_path = "%s.tmp" % path
+    with open(tmp_path, "w") as fout:
+        json.dump(data, fout)
+    os.replace(tmp_path, path)
+
+
 def start_daemon_thread(target, args=()):
     th = threading.Thread(target=target, args=args)
     th.daemon = True
@@ -1403,6 +3510,54 @@ def start_daemon_thread(target, args=()):
     return th
 
 
+def forward_worker_main(forwarder_cls, config, args, conn, parent_pid, inherited=()):
+    # runs in a worker process of ForwardSocketWorkers
+    for c in inherited:
+        c.close()
+    forwarder = forwarder_cls()
+    for key, value in config.items():
+        setattr(forwarder, key, value)
+    ip, port, toip, toport, udp = args
+    try:
+        forwarder.start_forward(ip, port, toip, toport, udp=udp)
+        # a worker outliving its parent is adopted by another process
+        while os.getppid() == parent_pid:
+            conn.send(forwarder.stats())
+            time.sleep(1)
+    except (KeyboardInterrupt, EOFError, BrokenPipeError):
+        pass
+    except Exception as ex:
+        Logger.error("fwd-workers: process %d is exiting: %s" % (os.getpid(), ex))
+    finally:
+        forwarder.stop_forward()
+
+
+def port_listening(port, udp=False):
+    # A TCP socket in LISTEN state, or an unconnected UDP socket, on the
+    # port. Dual-stack listeners (e.g. Go's ":port") are only in the IPv6
+    # tables. Returns None where /proc/net is not available.
+    names = ("udp", "udp6") if udp else ("tcp", "tcp6")
+    lines = None
+    for name in names:
+        try:
+            with open("/proc/net/%s" % name, "r") as fin:
+                lines = (lines or []) + fin.readlines()[1:]
+        except (OSError, IOError):
+            continue
+    if lines is None:
+        return None
+    for line in lines:
+        fields = line.split()
+        local, remote, state = fields[1], fields[2], fields[3]
+        if int(local.split(":")[1], 16) != port:
+            continue
+        if udp and state == "07" and remote.endswith(":0000"):
+            return True
+        if not udp and state == "0A":
+            return True
+    return False
+
+
 def closed_socket_ex(ex):
     if not hasattr(ex, "errno"):
         return False
@@ -1537,6 +3692,22 @@ def validate_filepath(s, err=True):
     return False
 
 
+def parse_mapping_str(s, udp=False):
+    # [tcp:|udp:][<bind port>:]<ip>:<port>
+    l = s.split(":")
+    if l[0].lower() in ("tcp", "udp"):
+        udp = l.pop(0).lower() == "udp"
+    if len(l) == 2:
+        l.insert(0, "0")
+    if len(l) != 3:
+        raise ValueError("Invalid mapping: %s" % s)
+    bind_port, to_ip, to_port = l
+    validate_port(bind_port)
+    validate_ip(to_ip)
+    validate_port(to_port)
+    return udp, int(bind_port), to_ip, int(to_port)
+
+
 def ip_normalize(ipaddr):
     return socket.inet_ntoa(socket.inet_aton(ipaddr))
 
@@ -1569,18 +3740,38 @@ def natter_main(show_title = True):
         "-k", type=int, metavar="<interval>", default=15,
         help="seconds between each keep-alive"
     )
+    group.add_argument(
+        "--adaptive-keep-alive", action="store_true",
+        help="learn the NAT mapping timeout and lengthen -k to fit it (UDP only)"
+    )
     group.add_argument(
         "-s", metavar="<address>", action="append",
         help="hostname or address to STUN server"
     )
     group.add_argument(
-        "-h", type=str, metavar="<address>", default=None,
-        help="hostname or address to keep-alive server"
+        "--stun-parallel", type=int, metavar="<n>", default=1,
+        help="query <n> STUN servers at once and use the fastest answer"
+    )
+    group.add_argument(
+        "--stun-scoreboard", type=str, metavar="<path>", default=None,
+        help="file to keep STUN server health in, so the fastest are tried first"
+    )
+    group.add_argument(
+        "-h", metavar="<address>", action="append",
+        help="hostname or address to keep-alive server, repeat for failover"
+    )
+    group.add_argument(
+        "--keep-alive-parallel", type=int, metavar="<n>", default=1,
+        help="send each keep-alive to <n> servers at once"
     )
     group.add_argument(
         "-e", type=str, metavar="<path>", default=None,
         help="script path for notifying mapped address"
     )
+    group.add_argument(
+        "--stats-file", type=str, metavar="<path>", default=None,
+        help="file to write forwarding statistics to (JSON) every keep-alive"
+    )
     group = argp.add_argument_group("bind options")
     group.add_argument(
         "-i", type=str, metavar="<interface>", default="0.0.0.0",
@@ -1594,7 +3785,7 @@ def natter_main(show_title = True):
     group.add_argument(
         "-m", type=str, metavar="<method>", default=None,
         help="forward method, common values are 'iptables', 'nftables', "
-             "'socat', 'gost' and 'socket'"
+             "'socat', 'gost', 'socket', 'socket-splice' and 'socket-loop'"
     )
     group.add_argument(
         "-t", type=str, metavar="<address>", default="0.0.0.0",
@@ -1604,26 +3795,83 @@ def natter_main(show_title = True):
         "-p", type=int, metavar="<port>", default=0,
         help="port number of forward target"
     )
+    group.add_argument(
+        "--map", type=str, metavar="<mapping>", action="append",
+        help="open one more port in this process, as [tcp:|udp:][<bind port>:]<ip>:<port>; "
+             "can be used multiple times, replaces -b, -t and -p, and -u sets the default protocol"
+    )
     group.add_argument(
         "-r", action="store_true", help="keep retrying until the port of forward target is open"
     )
+    group.add_argument(
+        "--backlog", type=int, metavar="<n>", default=128,
+        help="connections waiting to be forwarded before new ones are rejected"
+    )
+    group.add_argument(
+        "--max-conns", type=int, metavar="<n>", default=0,
+        help="connections forwarded concurrently by the socket methods"
+    )
+    group.add_argument(
+        "--max-sessions", type=int, metavar="<n>", default=4096,
+        help="UDP sessions kept by the socket methods before evicting the idlest"
+    )
+    group.add_argument(
+        "--prewarm", type=int, metavar="<n>", default=0,
+        help="idle TCP connections to the forward target kept open by the socket methods"
+    )
+    group.add_argument(
+        "--processes", type=int, metavar="<n>", default=1,
+        help="run the socket methods in <n> processes sharing the port (SO_REUSEPORT)"
+    )
+    group.add_argument(
+        "--rcvbuf", type=int, metavar="<bytes>", default=0,
+        help="SO_RCVBUF size for forwarding sockets, system default if not set"
+    )
+    group.add_argument(
+        "--sndbuf", type=int, metavar="<bytes>", default=0,
+        help="SO_SNDBUF size for forwarding sockets, system default if not set"
+    )
+    group.add_argument(
+        "--rate-limit", type=int, metavar="<KiB/s>", default=0,
+        help="bandwidth of the socket methods shared fairly by all clients"
+    )
+    group.add_argument(
+        "--rate-limit-ip", type=int, metavar="<KiB/s>", default=0,
+        help="bandwidth of the socket methods for each client IP; with --processes, "
+             "each process allows its share, so a client using one process gets less"
+    )
 
     args = argp.parse_args()
     verbose = args.v
     udp_mode = args.u
     upnp_enabled = args.U
     interval = args.k
+    adaptive_keep_alive = args.adaptive_keep_alive
     stun_list = args.s
-    keepalive_srv = args.h
+    stun_parallel = args.stun_parallel
+    stun_scoreboard = args.stun_scoreboard
+    keepalive_list = args.h
+    keepalive_parallel = args.keep_alive_parallel
     notify_sh = args.e
+    stats_file = args.stats_file
     bind_ip = args.i
     bind_interface = None
     bind_port = args.b
     method = args.m
     to_ip = args.t
     to_port = args.p
+    mapping_list = args.map
     keep_retry = args.r
     exit_when_changed = args.q
+    fwd_backlog = args.backlog
+    fwd_max_conns = args.max_conns
+    fwd_max_sessions = args.max_sessions
+    fwd_processes = args.processes
+    fwd_prewarm = args.prewarm
+    sock_rcvbuf = args.rcvbuf
+    sock_sndbuf = args.sndbuf
+    rate_limit = args.rate_limit
+    rate_limit_ip = args.rate_limit_ip
 
     if verbose:
         Logger.set_level(Logger.DEBUG)
@@ -1631,10 +3879,14 @@ def natter_main(show_title = True):
         sys.tracebacklimit = 0
 
     validate_positive(interval)
+    validate_positive(stun_parallel)
     if stun_list:
         for stun_srv in stun_list:
             validate_addr_str(stun_srv)
-    validate_addr_str(keepalive_srv)
+    if keepalive_list:
+        for keepalive_srv in keepalive_list:
+            validate_addr_str(keepalive_srv)
+    validate_positive(keepalive_parallel)
     if notify_sh:
         validate_filepath(notify_sh)
     if not validate_ip(bind_ip, err=False):
@@ -1643,61 +3895,92 @@ def natter_main(show_title = True):
     validate_port(bind_port)
     validate_ip(to_ip)
     validate_port(to_port)
+    if mapping_list:
+        mappings = [NatterMapping(*parse_mapping_str(m, udp_mode)) for m in mapping_list]
+    else:
+        mappings = [NatterMapping(udp_mode, bind_port, to_ip, to_port)]
+    validate_positive(fwd_backlog)
+    if fwd_max_conns:
+        validate_positive(fwd_max_conns)
+    validate_positive(fwd_max_sessions)
+    validate_positive(fwd_processes)
+    if fwd_prewarm:
+        validate_positive(fwd_prewarm)
+    if sock_rcvbuf:
+        validate_positive(sock_rcvbuf)
+    if sock_sndbuf:
+        validate_positive(sock_sndbuf)
+    if rate_limit:
+        validate_positive(rate_limit)
+    if rate_limit_ip:
+        validate_positive(rate_limit_ip)
 
     # Normalize IPv4 in dotted-decimal notation
     #   e.g. 10.1 -> 10.0.0.1
     bind_ip = ip_normalize(bind_ip)
-    to_ip = ip_normalize(to_ip)
-
-    if not stun_list:
-        stun_list = [
-            "fwa.lifesizecloud.com",
-            "global.turn.twilio.com",
-            "turn.cloudflare.com",
-            "stun.nextcloud.com",
-            "stun.freeswitch.org",
-            "stun.voip.blackberry.com",
-            "stun.sipnet.com",
-            "stun.radiojar.com",
-            "stun.sonetel.com",
-            "stun.telnyx.com"
-        ]
-        if not udp_mode:
-            stun_list = stun_list + [
-                "turn.cloud-rtc.com:80"
+    for m in mappings:
+        m.to_ip = ip_normalize(m.to_ip)
+
+    # server lists of each protocol in use, the defaults differ
+    stun_srv_lists = {}
+    keepalive_srv_lists = {}
+    for udp in set(m.udp for m in mappings):
+        stun_list_proto = stun_list
+        if not stun_list_proto:
+            stun_list_proto = [
+                "fwa.lifesizecloud.com",
+                "global.turn.twilio.com",
+                "turn.cloudflare.com",
+                "stun.nextcloud.com",
+                "stun.freeswitch.org",
+                "stun.voip.blackberry.com",
+                "stun.sipnet.com",
+                "stun.radiojar.com",
+                "stun.sonetel.com",
+                "stun.telnyx.com"
             ]
-        else:
-            stun_list = [
-                "stun.miwifi.com",
-                "stun.chat.bilibili.com",
-                "stun.hitv.com",
-                "stun.cdnbye.com",
-                "stun.douyucdn.cn:18000"
-            ] + stun_list
-
-    if not keepalive_srv:
-        keepalive_srv = "www.baidu.com"
-        if udp_mode:
-            keepalive_srv = "119.29.29.29"
-
-    stun_srv_list = []
-    for item in stun_list:
-        l = item.split(":", 2) + ["3478"]
-        stun_srv_list.append((l[0], int(l[1])),)
-
-    if udp_mode:
-        l = keepalive_srv.split(":", 2) + ["53"]
-        keepalive_host, keepalive_port = l[0], int(l[1])
-    else:
-        l = keepalive_srv.split(":", 2) + ["80"]
-        keepalive_host, keepalive_port = l[0], int(l[1])
+            if not udp:
+                stun_list_proto = stun_list_proto + [
+                    "turn.cloud-rtc.com:80"
+                ]
+            else:
+                stun_list_proto = [
+                    "stun.miwifi.com",
+                    "stun.chat.bilibili.com",
+                    "stun.hitv.com",
+                    "stun.cdnbye.com",
+                    "stun.douyucdn.cn:18000"
+                ] + stun_list_proto
+
+        keepalive_list_proto = keepalive_list
+        if not keepalive_list_proto:
+            keepalive_list_proto = [
+                "www.baidu.com",
+                "www.qq.com"
+            ]
+            if udp:
+                keepalive_list_proto = [
+                    "119.29.29.29",
+                    "223.5.5.5"
+                ]
+
+        stun_srv_lists[udp] = []
+        for item in stun_list_proto:
+            l = item.split(":", 2) + ["3478"]
+            stun_srv_lists[udp].append((l[0], int(l[1])),)
+
+        keepalive_srv_lists[udp] = []
+        for item in keepalive_list_proto:
+            l = item.split(":", 2) + ["53" if udp else "80"]
+            keepalive_srv_lists[udp].append((l[0], int(l[1])),)
 
     # forward method defaults
     if not method:
-        if to_ip == "0.0.0.0" and to_port == 0 and \
-                bind_ip == "0.0.0.0" and bind_port == 0 and bind_interface is None:
+        no_target = all(m.to_ip == "0.0.0.0" and m.to_port == 0 for m in mappings)
+        if no_target and all(m.bind_port == 0 for m in mappings) and \
+                bind_ip == "0.0.0.0" and bind_interface is None:
             method = "test"
-        elif to_ip == "0.0.0.0" and to_port == 0:
+        elif no_target:
             method = "none"
         else:
             method = "socket"
@@ -1728,6 +4011,10 @@ def natter_main(show_title = True):
         ForwardImpl = ForwardGost
     elif method == "socket":
         ForwardImpl = ForwardSocket
+    elif method == "socket-splice":
+        ForwardImpl = ForwardSocketSplice
+    elif method == "socket-loop":
+        ForwardImpl = ForwardSocketLoop
     else:
         raise ValueError("Unknown method name: %s" % method)
     #
@@ -1740,39 +4027,68 @@ def natter_main(show_title = True):
 
     check_docker_network()
 
-    forwarder = ForwardImpl()
+    def new_forwarder():
+        config = {}
+        if issubclass(ForwardImpl, ForwardSocket):
+            config["rcvbuf"] = sock_rcvbuf
+            config["sndbuf"] = sock_sndbuf
+            config["backlog"] = fwd_backlog
+            if fwd_max_conns:
+                config["max_conns"] = fwd_max_conns
+            config["max_sessions"] = fwd_max_sessions
+            config["prewarm"] = fwd_prewarm
+            # each worker process limits its own share of the rates, since the
+            # connections of one client are spread over the workers too
+            if rate_limit:
+                config["rate_limit"] = max(rate_limit * 1024 // fwd_processes, 1)
+            if rate_limit_ip:
+                config["rate_limit_ip"] = max(rate_limit_ip * 1024 // fwd_processes, 1)
+        elif rate_limit or rate_limit_ip:
+            raise ValueError("Rate limiting is only supported by socket methods")
+        if fwd_processes > 1:
+            if not issubclass(ForwardImpl, ForwardSocket):
+                raise ValueError("Multiple processes are only supported by socket methods")
+            return ForwardSocketWorkers(ForwardImpl, config, fwd_processes)
+        forwarder = ForwardImpl()
+        for key, value in config.items():
+            setattr(forwarder, key, value)
+        return forwarder
+
+    # the kernel methods keep the rules of all mappings in one table,
+    # the others listen on the port of their mapping
+    forwarders = []
+    mapping_forwarders = []
+    for m in mappings:
+        if not forwarders or not issubclass(ForwardImpl, (ForwardIptables, ForwardNftables)):
+            forwarders.append(new_forwarder())
+        mapping_forwarders.append(forwarders[-1])
     port_test = PortTest()
+    scoreboard = StunScoreboard(stun_scoreboard)
 
-    stun = StunClient(stun_srv_list, bind_ip, bind_port, udp=udp_mode, interface=bind_interface)
-    natter_addr, outer_addr = stun.get_mapping()
-    # set actual ip and port for keep-alive socket to bind, instead of zero
-    bind_ip, bind_port = natter_addr
-
-    keep_alive = KeepAlive(keepalive_host, keepalive_port, bind_ip, bind_port, udp=udp_mode, interface=bind_interface)
-    keep_alive.keep_alive()
-
-    # get the mapped address again after the keep-alive connection is established
-    outer_addr_prev = outer_addr
-    natter_addr, outer_addr = stun.get_mapping()
-    if outer_addr != outer_addr_prev:
-        Logger.warning("Network is unstable, or not full cone")
-
-    # set actual ip of localhost for correct forwarding
-    if socket.inet_aton(to_ip) in [socket.inet_aton("127.0.0.1"), socket.inet_aton("0.0.0.0")]:
-        to_ip = natter_addr[0]
+    # a keep-alive waits for replies until its socket timeout, which must end
+    # well before the next deadline, or short intervals miss every one
+    keepalive_timeout = min(3, interval / 2)
 
-    # if not specified, the target port is set to be the same as the outer port
-    if not to_port:
-        to_port = outer_addr[1]
+    def open_mapping(m, forwarder, analyze=0):
+        stun = StunClient(stun_srv_lists[m.udp], bind_ip, m.bind_port, udp=m.udp,
+                          interface=bind_interface, parallel=stun_parallel, scoreboard=scoreboard)
+        m.open(forwarder, stun, keepalive_srv_lists[m.udp], keepalive_parallel, analyze=analyze,
+               keepalive_timeout=keepalive_timeout)
 
-    # some exceptions: ForwardNone and ForwardTestServer are not real forward methods,
-    # so let target ip and port equal to natter's
-    if ForwardImpl in (ForwardNone, ForwardTestServer):
-        to_ip, to_port = natter_addr
-
-    to_addr = (to_ip, to_port)
-    forwarder.start_forward(natter_addr[0], natter_addr[1], to_addr[0], to_addr[1], udp=udp_mode)
-    NatterExit.set_atexit(forwarder.stop_forward)
+    def stop_all():
+        for forwarder in forwarders:
+            forwarder.stop_forward()
+        for m in mappings:
+            if m.keep_alive:
+                m.keep_alive.disconnect()
+
+    # the NAT type is the same for every port, analyze it once
+    open_mapping(mappings[0], mapping_forwarders[0], analyze=max(stun_parallel, 3))
+    nat_info = mappings[0].nat_info
+    if len(mappings) > 1:
+        with concurrent.futures.ThreadPoolExecutor(len(mappings) - 1) as executor:
+            list(executor.map(open_mapping, mappings[1:], mapping_forwarders[1:]))
+    NatterExit.set_atexit(stop_all)
 
     # UPnP
     upnp = None
@@ -1780,7 +4096,7 @@ def natter_main(show_title = True):
     upnp_ready = False
 
     if upnp_enabled:
-        upnp = UPnPClient(bind_ip=natter_addr[0], interface=bind_interface)
+        upnp = UPnPClient(bind_ip=mappings[0].natter_addr[0], interface=bind_interface)
         Logger.info()
         Logger.info("Scanning UPnP Devices...")
         try:
@@ -1790,89 +4106,116 @@ def natter_main(show_title = True):
 
     if upnp_router:
         Logger.info("[UPnP] Found router %s" % upnp_router.ipaddr)
-        try:
-            upnp.forward("", bind_port, bind_ip, bind_port, udp=udp_mode, duration=interval*3)
-        except (OSError, socket.error, ValueError) as ex:
-            Logger.error("upnp: failed to forward port: %s" % ex)
-        else:
-            upnp_ready = True
+        for m in mappings:
+            try:
+                upnp.forward("", m.natter_addr[1], m.natter_addr[0], m.natter_addr[1],
+                             udp=m.udp, duration=interval*3)
+            except (OSError, socket.error, ValueError) as ex:
+                Logger.error("upnp: failed to forward port: %s" % ex)
+            else:
+                upnp_ready = True
 
     # Display route information
     Logger.info()
-    route_str = ""
-    if ForwardImpl not in (ForwardNone, ForwardTestServer):
-        route_str += "%s <--%s--> " % (addr_to_uri(to_addr, udp=udp_mode), method)
-    route_str += "%s <--Natter--> %s" % (
-        addr_to_uri(natter_addr, udp=udp_mode), addr_to_uri(outer_addr, udp=udp_mode)
-    )
-    Logger.info(route_str)
+    for m in mappings:
+        Logger.info(m.route_str(method))
     Logger.info()
 
     # Test mode notice
     if ForwardImpl == ForwardTestServer:
         Logger.info("Test mode in on.")
-        Logger.info("Please check [ %s://%s ]" % ("udp" if udp_mode else "http", addr_to_str(outer_addr)))
+        for m in mappings:
+            Logger.info("Please check [ %s://%s ]" % ("udp" if m.udp else "http", addr_to_str(m.outer_addr)))
         Logger.info()
 
-    # Call notification script
-    if notify_sh:
-        protocol = "udp" if udp_mode else "tcp"
-        inner_ip, inner_port = to_addr if method else natter_addr
-        outer_ip, outer_port = outer_addr
+    # Call notification script, once for each mapping
+    def notify(m):
+        if not notify_sh:
+            return
+        inner_ip, inner_port = m.to_addr if method else m.natter_addr
+        outer_ip, outer_port = m.outer_addr
         Logger.info("Calling script: %s" % notify_sh)
         subprocess.call([
-            os.path.abspath(notify_sh), protocol, str(inner_ip), str(inner_port), str(outer_ip), str(outer_port)
+            os.path.abspath(notify_sh), m.protocol, str(inner_ip), str(inner_port), str(outer_ip), str(outer_port)
         ], shell=False)
 
+    for m in mappings:
+        notify(m)
+
     # Display check results, TCP only
-    if not udp_mode:
-        ret1 = port_test.test_lan(to_addr, info=True)
-        ret2 = port_test.test_lan(natter_addr, info=True)
-        ret3 = port_test.test_lan(outer_addr, source_ip=natter_addr[0], interface=bind_interface, info=True)
-        ret4 = port_test.test_wan(outer_addr, source_ip=natter_addr[0], interface=bind_interface, info=True)
+    target_closed = False
+    for m in mappings:
+        if m.udp:
+            continue
+        ret1 = port_test.test_lan(m.to_addr, info=True)
+        ret2 = port_test.test_lan(m.natter_addr, info=True)
+        ret3 = port_test.test_lan(m.outer_addr, source_ip=m.natter_addr[0], interface=bind_interface, info=True)
+        ret4 = port_test.test_wan(m.outer_addr, source_ip=m.natter_addr[0], interface=bind_interface, info=True)
         if ret1 == -1:
             Logger.warning("!! Target port is closed !!")
+            target_closed = True
         elif ret1 == 1 and ret3 == ret4 == -1:
             Logger.warning("!! Hole punching failed !!")
         elif ret3 == 1 and ret4 == -1:
             Logger.warning("!! You may be behind a firewall !!")
         Logger.info()
-        # retry
-        if keep_retry and ret1 == -1:
-            Logger.info("Retry after %d seconds..." % interval)
-            time.sleep(interval)
-            forwarder.stop_forward()
-            keep_alive.disconnect()
-            raise NatterRetryException("Target port is closed")
+    # retry
+    if keep_retry and target_closed:
+        Logger.info("Retry after %d seconds..." % interval)
+        time.sleep(interval)
+        stop_all()
+        raise NatterRetryException("Target port is closed")
     #
     #  Main loop
     #
-    need_recheck = False
-    cnt = 0
-    while True:
-        # force recheck every 20th loop
-        cnt = (cnt + 1) % 20
-        if cnt == 0:
-            need_recheck = True
-        if need_recheck:
-            Logger.debug("Start recheck")
-            need_recheck = False
-            # check LAN port first
-            if udp_mode or port_test.test_lan(outer_addr, source_ip=natter_addr[0], interface=bind_interface) == -1:
-                # then check through STUN
-                _, outer_addr_curr = stun.get_mapping()
-                if outer_addr_curr != outer_addr:
-                    forwarder.stop_forward()
-                    keep_alive.disconnect()
-                    # exit or retry
-                    if exit_when_changed:
-                        Logger.info("Natter is exiting because mapped address has changed")
-                        raise NatterExitException("Mapped address has changed")
-                    raise NatterRetryException("Mapped address has changed")
-        # end of recheck
-        ts = time.time()
+    supervisor = NatterSupervisor()
+
+    def job_name(name, m):
+        # a single mapping keeps the plain job names
+        return name if len(mappings) == 1 else "%s %s" % (name, m)
+
+    def do_recheck(m):
+        Logger.debug("Start recheck")
+        # check LAN port first
+        if m.udp or port_test.test_lan(m.outer_addr, source_ip=m.natter_addr[0], interface=bind_interface) == -1:
+            # then check through STUN
+            natter_addr_curr, outer_addr_curr = m.stun.get_mapping()
+            if outer_addr_curr != m.outer_addr:
+                if exit_when_changed:
+                    Logger.info("Natter is exiting because mapped address has changed")
+                    raise NatterExitException("Mapped address has changed")
+                if natter_addr_curr != m.natter_addr:
+                    raise NatterRetryException("Local address has changed")
+                do_remap(m, outer_addr_curr)
+
+    def do_remap(m, outer_addr_curr):
+        # Follow the new outer address without restarting: the forwarder,
+        # the other mappings and established connections are kept.
+        ts = time.monotonic()
+        # the port was unusable since keep-alive failed, if it did
+        since = m.broken_since or ts
+        # hold the new mapping open right away
+        supervisor.wake(job_name("keep-alive", m))
+        try:
+            m.remap(outer_addr_curr)
+        except (OSError, socket.error, ValueError, subprocess.CalledProcessError) as ex:
+            Logger.error("Cannot follow the new mapped address, restarting: %s" % ex)
+            raise NatterRetryException("Mapped address has changed")
+        Logger.info()
+        Logger.info(m.route_str(method))
+        Logger.info()
+        notify(m)
+        now = time.monotonic()
+        m.last_outage = now - since
+        Logger.info("Mapped address has changed, remapped in %.0f ms, outage %.1f seconds" % (
+            (now - ts) * 1000, m.last_outage
+        ))
+
+    def do_keep_alive(m):
+        ts = time.monotonic()
         try:
-            keep_alive.keep_alive()
+            m.keep_alive.keep_alive()
+            m.broken_since = None
         except (OSError, socket.error) as ex:
             if hasattr(errno, "EADDRNOTAVAIL") and \
                     ex.errno == errno.EADDRNOTAVAIL:
@@ -1881,20 +4224,77 @@ def natter_main(show_title = True):
                                 "has changed")
                     raise NatterExitException("Local IP address has changed")
                 raise NatterRetryException("Local IP address has changed")
-            if udp_mode:
+            if m.udp:
                 Logger.debug("keep-alive: UDP response not received: %s" % ex)
             else:
                 Logger.error("keep-alive: connection broken: %s" % ex)
-            keep_alive.disconnect()
-            need_recheck = True
-        if upnp_ready:
+            m.keep_alive.disconnect()
+            if m.broken_since is None:
+                m.broken_since = ts
+            supervisor.wake(job_name("recheck", m))
+
+    def do_upnp_renew():
+        try:
+            upnp.renew()
+        except (OSError, socket.error) as ex:
+            Logger.error("upnp: failed to renew upnp: %s" % ex)
+
+    def do_stats():
+        for m in mappings:
+            name = job_name("keep-alive", m)
+            st = supervisor.stats()[name]
+            Logger.debug("%s: %d runs, %d missed deadlines, late %.1f/%.1f ms avg/max" % (
+                name, st["runs"], st["missed"], st["late_avg_ms"], st["late_max_ms"]
+            ))
+        for m, forwarder in zip(mappings, mapping_forwarders):
+            if hasattr(forwarder, "stats_str"):
+                Logger.debug("%s: %s" % (job_name("fwd-socket", m), forwarder.stats_str()))
+        if stats_file:
             try:
-                upnp.renew()
-            except (OSError, socket.error) as ex:
-                Logger.error("upnp: failed to renew upnp: %s" % ex)
-        sleep_sec = interval - (time.time() - ts)
-        if sleep_sec > 0:
-            time.sleep(sleep_sec)
+                write_json_file(stats_file, {
+                    "timestamp":    int(time.time()),
+                    "method":       method,
+                    "protocol":     mappings[0].protocol,
+                    "outer_addr":   addr_to_str(mappings[0].outer_addr),
+                    "nat_type":     nat_info["type"],
+                    "scheduler":    supervisor.stats(),
+                    "forward":      ForwardMetrics.merge(
+                        f.stats() for f in forwarders if hasattr(f, "stats")
+                    ),
+                    "mappings":     [m.stats() for m in mappings]
+                })
+            except (OSError, IOError) as ex:
+                Logger.error("Cannot write statistics to %s: %s" % (stats_file, ex))
+
+    for m in mappings:
+        supervisor.add_job(job_name("keep-alive", m), lambda m=m: do_keep_alive(m), interval)
+    udp_mappings = [m for m in mappings if m.udp]
+    if adaptive_keep_alive:
+        if udp_mappings:
+            # the NAT mapping timeout is the same for every UDP port
+            def on_settle(sec):
+                for m in udp_mappings:
+                    supervisor.set_interval(job_name("keep-alive", m), sec)
+            tuner = KeepAliveTuner(
+                udp_mappings[0].stun.stun_server_list[0], interval,
+                udp_mappings[0].natter_addr[0], bind_interface, on_settle=on_settle
+            )
+            supervisor.add_job("keep-alive-tuner", tuner.step, interval)
+        else:
+            Logger.warning("Adaptive keep-alive is only supported in UDP mode")
+    # force recheck every 20 keep-alive intervals, or when keep-alive fails
+    for m in mappings:
+        supervisor.add_job(job_name("recheck", m), lambda m=m: do_recheck(m),
+                           interval * 20, delay=interval * 20)
+    if upnp_ready:
+        supervisor.add_job("upnp", do_upnp_renew, interval)
+    supervisor.add_job("stats", do_stats, interval)
+    # jobs only raise; everything is stopped once no job runs any more, so
+    # none of them finds its keep-alive socket closed under it
+    try:
+        supervisor.run()
+    finally:
+        stop_all()
 
 
 def main():